@@ -6,13 +6,21 @@ from starlette.staticfiles import StaticFiles
 from scripts.endpoints.csv_file import (
     assign_tables_to_map,
     load_csv_file,
+    stream_csv_file,
     get_csv_metas,
     get_csv_json,
     proceed_csv,
+    proceed_csv_job,
+    append_csv,
     get_proceed,
+    get_csv_file,
+    get_storage_report,
+    get_cache_stats,
 )
-from scripts.endpoints.map import get_maps_meta, create_map, proceed_maps
+from scripts.endpoints.map import get_maps_meta, create_map, proceed_maps, proceed_maps_job
 from scripts.endpoints.ouauth import login_for_token, register
+from scripts.endpoints.task import get_task, get_task_result, stream_task
+from scripts.endpoints.upload import create_upload, finalize_upload, get_upload, put_upload_chunk
 from scripts.shared.api import (
     get_app,
     Group,
@@ -34,16 +42,37 @@ API = get_app(
         Router('post', 'map', create_map, include=True),
         Router('post', 'map/assign', assign_tables_to_map, include=True),
         Router('post', 'map/assign/get', proceed_maps, include=True),
+        Router('get', 'map/assign/get', proceed_maps, include=True),
+        Router('post', 'map/assign/job', proceed_maps_job, include=True),
         tags=['map']
     ),
     Group(
         Router('post', 'csv', load_csv_file, include=True),
+        Router('post', 'csv/stream', stream_csv_file, include=True),
         Router('get', 'csvs', get_csv_metas, include=True),
         Router('get', 'csv/json', get_csv_json, include=True),
         Router('post', 'csv/proceed', proceed_csv, include=True),
+        Router('post', 'csv/proceed/job', proceed_csv_job, include=True),
+        Router('post', 'csv/append', append_csv, include=True),
         Router('get', 'csv/proceed-zip', get_proceed, include=True),
+        Router('get', 'csv/download', get_csv_file, include=True),
+        Router('get', 'csv/storage', get_storage_report, include=True),
+        Router('get', 'csv/cache', get_cache_stats, include=True),
         tags=['csv']
     ),
+    Group(
+        Router('post', 'csv/upload', create_upload, include=True),
+        Router('get', 'csv/upload', get_upload, include=True),
+        Router('put', 'csv/upload/chunk', put_upload_chunk, include=True),
+        Router('post', 'csv/upload/finalize', finalize_upload, include=True),
+        tags=['upload']
+    ),
+    Group(
+        Router('get', 'task', get_task, include=True),
+        Router('get', 'task/stream', stream_task, include=True),
+        Router('get', 'task/result', get_task_result, include=True),
+        tags=['task']
+    ),
     mount=[
         Mount(str(Path.cwd() / 'data'), StaticFiles(directory='data'), 'data'),
         Mount(str(Path.cwd() / 'static'), StaticFiles(directory='static'), 'static')
@@ -1,10 +1,17 @@
 import io
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import cached_property
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import requests
 
 BASE_URL = 'http://89.104.68.100:8090'
 
+FINAL_EVENTS = ('done', 'failed')
+
 
 class Api:
 
@@ -41,7 +48,7 @@ class Api:
             description='',
     ):
         return requests.post(
-            f'{BASE_URL}/api/csv',
+            f'{BASE_URL}/api/csv/stream',
             params=dict(
                 name=name,
                 latitude=latitude,
@@ -49,10 +56,77 @@ class Api:
                 type=_type,
                 description=description,
             ),
-            files={'data': file},
+            data=file,
             headers={'Authorization': f'Bearer {self.access_token}'}
         ).json()['id']
 
+    def upload_session(self, session_id: str) -> Dict:
+        return requests.get(
+            f'{BASE_URL}/api/csv/upload',
+            params={'id': session_id},
+            headers={'Authorization': f'Bearer {self.access_token}'},
+        ).json()
+
+    def upload_chunk(self, session_id: str, index: int, chunk: bytes, retries: int = 5) -> Dict:
+        for attempt in range(retries):
+            try:
+                resp = requests.put(
+                    f'{BASE_URL}/api/csv/upload/chunk',
+                    params={'id': session_id, 'index': index},
+                    data=chunk,
+                    headers={'Authorization': f'Bearer {self.access_token}'},
+                )
+                resp.raise_for_status()
+                return resp.json()
+            except requests.RequestException:
+                if attempt == retries - 1:
+                    raise
+                time.sleep(2 ** attempt)
+
+    def upload_csv_chunked(
+            self,
+            path: str,
+            name: str = 'test',
+            latitude: float = 0,
+            longitude: float = 0,
+            _type: str = 'input_data',
+            description='',
+            chunk_size: int = 8 * 1024 * 1024,
+            workers: int = 4,
+            session_id: str = None,
+    ):
+        if session_id is None:
+            session = requests.post(
+                f'{BASE_URL}/api/csv/upload',
+                params=dict(
+                    name=name,
+                    latitude=latitude,
+                    longitude=longitude,
+                    type=_type,
+                    description=description,
+                    chunk_size=chunk_size,
+                    size=os.path.getsize(path),
+                ),
+                headers={'Authorization': f'Bearer {self.access_token}'},
+            ).json()
+        else:
+            session = self.upload_session(session_id)
+        received = frozenset(session['received'])
+        total = -(-os.path.getsize(path) // session['chunk_size'])
+
+        def send(index: int):
+            with open(path, 'rb') as f:
+                f.seek(index * session['chunk_size'])
+                return self.upload_chunk(session['id'], index, f.read(session['chunk_size']))
+
+        with ThreadPoolExecutor(workers) as pool:
+            list(pool.map(send, [index for index in range(total) if index not in received]))
+        return requests.post(
+            f'{BASE_URL}/api/csv/upload/finalize',
+            params={'id': session['id']},
+            headers={'Authorization': f'Bearer {self.access_token}'},
+        ).json()['id']
+
     def get_csvs(
             self,
     ):
@@ -64,33 +138,133 @@ class Api:
     def get_csv_json(
             self,
             _id: str,
+            limit: Optional[int] = 5,
+            cursor: Optional[str] = None,
+            columns: Optional[List[str]] = None,
     ):
         return requests.get(
             f'{BASE_URL}/api/csv/json',
-            params={'id': _id},
+            params={'id': _id, 'limit': limit, 'cursor': cursor, 'columns': columns},
             headers={'Authorization': f'Bearer {self.access_token}'},
         ).json()
 
     def proceed_csv(
             self,
-            _id: str
+            _id: str,
+            *windows: Tuple[int, int],
     ):
         return requests.post(
             f'{BASE_URL}/api/csv/proceed',
             params={'id': _id},
+            json=list(windows) or None,
+            headers={'Authorization': f'Bearer {self.access_token}'},
+        ).json()
+
+    def proceed_csv_job(
+            self,
+            _id: str,
+            *windows: Tuple[int, int],
+    ):
+        return requests.post(
+            f'{BASE_URL}/api/csv/proceed/job',
+            params={'id': _id},
+            json=list(windows) or None,
+            headers={'Authorization': f'Bearer {self.access_token}'},
+        ).json()['id']
+
+    def get_task(
+            self,
+            task_id: int,
+    ):
+        return requests.get(
+            f'{BASE_URL}/api/task',
+            params={'id': task_id},
             headers={'Authorization': f'Bearer {self.access_token}'},
         ).json()
 
+    def stream_task(
+            self,
+            task_id: int,
+            retries: int = 5,
+    ):
+        # every connection starts with the current state, so a dropped stream is simply reopened,
+        # retries only run out when connections keep failing without delivering any event
+        attempt = 0
+        while True:
+            if attempt:
+                time.sleep(2 ** (attempt - 1))
+            event, received, error = None, False, None
+            try:
+                with requests.get(
+                        f'{BASE_URL}/api/task/stream',
+                        params={'id': task_id},
+                        headers={'Authorization': f'Bearer {self.access_token}'},
+                        stream=True,
+                ) as resp:
+                    resp.raise_for_status()
+                    for line in resp.iter_lines(decode_unicode=True):
+                        if line.startswith('event:'):
+                            event = line[len('event:'):].strip()
+                        elif line.startswith('data:'):
+                            received = True
+                            yield event, json.loads(line[len('data:'):])
+                            if event in FINAL_EVENTS:
+                                return
+            except requests.RequestException as e:
+                error = e
+            attempt = 0 if received else attempt + 1
+            if attempt == retries:
+                if error is not None:
+                    raise error
+                raise requests.ConnectionError(f'task {task_id} stream closed {retries} times before the task finished')
+
+    def wait_task(
+            self,
+            task_id: int,
+            on_progress: Callable[[Dict], Any] = print,
+    ):
+        meta = None
+        for event, meta in self.stream_task(task_id):
+            on_progress(meta)
+        return meta
+
+    def append_csv(
+            self,
+            _id: str,
+            file: io.FileIO,
+    ):
+        return requests.post(
+            f'{BASE_URL}/api/csv/append',
+            params={'id': _id},
+            files={'data': file},
+            headers={'Authorization': f'Bearer {self.access_token}'},
+        ).json()
+
+    def download_csv(self, _id: str, outfile: str = None):
+        if outfile is None:
+            outfile = f'{_id}.csv'
+        data = requests.get(
+            f'{BASE_URL}/api/csv/download',
+            params={'id': _id},
+            headers={'Authorization': f'Bearer {self.access_token}'},
+            stream=True,
+        )
+        with open(outfile, 'wb') as f:
+            for chunk in data.iter_content(1 << 16):
+                f.write(chunk)
+        return outfile
+
     def csv_get_zip(
             self,
             _id: str,
             outfile: str = None,
+            level: int = 6,
     ):
         if outfile is None:
             outfile = f'csvs_{_id}.zip'
         data = requests.get(
             f'{BASE_URL}/api/csv/proceed-zip',
-            params={'id': _id},
+            params={'id': _id, 'level': level},
             headers={'Authorization': f'Bearer {self.access_token}'},
             stream=True,
         )
@@ -122,17 +296,39 @@ class Api:
             headers={'Authorization': f'Bearer {self.access_token}'},
         )
 
+    def maps_job(self, map_id: str, layout: str = 'years'):
+        return requests.post(
+            f'{BASE_URL}/api/map/assign/job',
+            params={'map_id': map_id, 'layout': layout},
+            headers={'Authorization': f'Bearer {self.access_token}'},
+        ).json()['id']
+
+    def task_get_zip(self, task_id: int, outfile: str = None):
+        if outfile is None:
+            outfile = f'task_{task_id}.zip'
+        data = requests.get(
+            f'{BASE_URL}/api/task/result',
+            params={'id': task_id},
+            headers={'Authorization': f'Bearer {self.access_token}'},
+            stream=True,
+        )
+        with open(outfile, 'wb') as f:
+            for chunk in data:
+                f.write(chunk)
+        return outfile
+
     def maps_get_zip(
             self,
             map_id: str,
             *dfs: str,
             outfile: str = None,
+            layout: str = 'years',
     ):
         if outfile is None:
             outfile = f'maps_{map_id}.zip'
         data = requests.post(
             f'{BASE_URL}/api/map/assign/get',
-            params={'map_id': map_id, },
+            params={'map_id': map_id, 'layout': layout},
             json=list(dfs),
             headers={'Authorization': f'Bearer {self.access_token}'},
             stream=True,
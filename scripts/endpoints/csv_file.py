@@ -1,33 +1,250 @@
+import asyncio
+import glob
+import hashlib
 import io
 import json
-import zipfile
-from typing import Annotated, Dict, Optional
+import os
+import shutil
+import tempfile
+from collections import defaultdict
+from contextlib import suppress
+from typing import Annotated, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple, Union
+from uuid import UUID, uuid4
 
-from fastapi import Depends, UploadFile, File, HTTPException
-from starlette.responses import StreamingResponse
+import pandas as pd
+from fastapi import Depends, UploadFile, File, HTTPException, Query, Request
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import FileResponse, Response, StreamingResponse
+from tortoise.transactions import in_transaction
 
-from scripts.endpoints.proceed import WeatherTable
+from scripts.endpoints.proceed import PIPELINE_VERSION, SEASON_WINDOWS, WeatherTable, append_files, proceed_files
+from scripts.endpoints.task import update_task
 from scripts.shared.user import get_current_user
-from scripts.models.api import CSVFileReqPyd
-from scripts.models.pg import CSVFile
+from scripts.models.api import BackgroundTaskResp, CSVFileReqPyd
+from scripts.models.enums import CsvTypes
+from scripts.models.pg import BackgroundTask, CSVFile, User
+from scripts.shared import blobs, columnar, jobs
+from scripts.shared.archive import stream_zip
+from scripts.shared.compression import codec_of, iter_bytes, table_compression
+from scripts.shared.ingest import file_chunks, ingest
+from scripts.shared.cache import TABLE_CACHE
 from scripts.shared.lab_tools import PandasTable
 from scripts.shared.security import permission_setter
 
+PRODUCT_TYPES = {
+    'ky': CsvTypes.proceed_data_Ky,
+    'ed': CsvTypes.proceed_data_Ed,
+    'em': CsvTypes.proceed_data_Em,
+    'gtk': CsvTypes.proceed_data_GTK,
+    'mean_t_months': CsvTypes.proceed_data_mean_t_months,
+    'active_months': CsvTypes.proceed_data_active_months,
+    'decades_grouped': CsvTypes.proceed_data_decades_grouped,
+    'em_active_months': CsvTypes.proceed_em_active_months,
+    'groupby_year': CsvTypes.groups_year,
+}
+PRODUCT_NAMES = {_type: name for name, _type in PRODUCT_TYPES.items()}
+
+APPEND_CHUNKSIZE = 100_000
+
+# proceeds and appends of one input read and rewrite the same totals, so they run one at a time
+INPUT_LOCKS: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+STORAGE_SUFFIXES = {
+    'columnar': '.col',
+    'csv': '.csv',
+}
+
+CODEC_SUFFIXES = {
+    'gzip': '.gz',
+}
+
+
+def option_set(options: Dict) -> Dict:
+    return {
+        'windows': [list(window) for window in options.get('windows', SEASON_WINDOWS)],
+        'compact': options.get('compact', False),
+    }
+
+
+def options_key(options: Dict) -> str:
+    return hashlib.sha256(json.dumps(option_set(options)).encode()).hexdigest()[:16]
+
+
+def table_options(options: Dict) -> Dict:
+    return {'windows': tuple(map(tuple, options['windows'])), 'compact': options['compact']}
+
+
+def totals_path(_id, options: Dict) -> str:
+    return f'data/csv/{_id}.{options_key(options)}.totals.pkl'
+
+
+def set_path(_id, options: Dict, set_id) -> str:
+    return f'data/csv/{_id}.{options_key(options)}.{set_id}.set.json'
+
+
+def save_option_set(_id, options: Dict, tables: List[CSVFile]):
+    path = set_path(_id, options, uuid4().hex)
+    with open(temp_path(path), 'w') as f:
+        json.dump({'options': option_set(options), 'tables': [f'{table.id}' for table in tables]}, f)
+    os.replace(temp_path(path), path)
+
+
+def option_sets(_id) -> Dict[str, Tuple[Dict, List[str]]]:
+    sets = {}
+    for path in glob.glob(f'data/csv/{_id}.*.set.json'):
+        with open(path) as f:
+            saved = json.load(f)
+        sets.setdefault(options_key(saved['options']), (saved['options'], []))[1].extend(saved['tables'])
+    return sets
+
+
+def table_storage() -> str:
+    return os.getenv('TABLE_STORAGE', 'columnar')
+
+
+def derived_format() -> Tuple[str, Optional[str]]:
+    storage = table_storage()
+    # columnar tables stay uncompressed so they can be memory-mapped
+    return storage, table_compression() if storage == 'csv' else None
+
+
+def table_suffix(storage: str, codec: Optional[str] = None) -> str:
+    return f'{STORAGE_SUFFIXES[storage]}{CODEC_SUFFIXES.get(codec, "")}'
+
+
+def table_path(_id, storage: Optional[str] = None, codec: Optional[str] = None) -> str:
+    if storage is not None:
+        return f'data/csv/{_id}{table_suffix(storage, codec)}'
+    for suffix in ('.col', *(f'.csv{suffix}' for suffix in CODEC_SUFFIXES.values()), '.csv'):
+        if os.path.exists(path := f'data/csv/{_id}{suffix}'):
+            return path
+    return f'data/csv/{_id}.csv'
+
+
+def digest_path(_id) -> str:
+    return f'data/csv/{_id}.sha256'
+
+
+def save_digest(_id, digest: str):
+    with open(digest_path(_id), 'w') as f:
+        f.write(digest)
+
+
+def tail_path(_id) -> str:
+    return f'data/csv/{_id}.tail.json'
+
+
+def save_tail(_id, **state):
+    with open(temp_path(tail_path(_id)), 'w') as f:
+        json.dump(state, f)
+    os.replace(temp_path(tail_path(_id)), tail_path(_id))
+
+
+def load_tail(_id) -> Dict:
+    with suppress(FileNotFoundError):
+        with open(tail_path(_id)) as f:
+            return json.load(f)
+    return {}
+
+
+def tail_date(path: str, tail: bytes) -> Optional[List[int]]:
+    header = pd.read_csv(path, nrows=0, compression=codec_of(path)).columns
+    line = tail.rstrip(b'\r\n').rsplit(b'\n', 1)[-1]
+    with suppress(Exception):
+        row = pd.read_csv(io.BytesIO(line), header=None, names=header).iloc[0]
+        return [int(row[col]) for col in ('YEAR', 'MO', 'DY')]
+    return None
+
+
+def input_digest(_id) -> str:
+    with suppress(FileNotFoundError):
+        with open(digest_path(_id)) as f:
+            return f.read()
+    digest = blobs.digest(iter_bytes(table_path(_id)))
+    save_digest(_id, digest)
+    return digest
+
+
+def results_key(digest: str, options: Dict) -> str:
+    params = json.dumps([PIPELINE_VERSION, *option_set(options).values()])
+    return f'{digest}.{hashlib.sha256(params.encode()).hexdigest()[:16]}'
+
+
+def valid_totals(path: str) -> bool:
+    try:
+        WeatherTable.load_totals(path)
+    except Exception:
+        return False
+    return True
+
+
+def temp_path(path: str) -> str:
+    return f'{path}.tmp'
+
+
+def discard_files(*paths: str):
+    for path in paths:
+        with suppress(FileNotFoundError):
+            os.remove(path)
+
+
+def map_archive_dir(map_id) -> str:
+    return f'data/maps/{map_id}'
+
+
+def discard_map_archives(*map_ids):
+    for map_id in map_ids:
+        shutil.rmtree(map_archive_dir(map_id), ignore_errors=True)
+
+
+def probe_upload(_type: CsvTypes) -> Callable[[bytes], None]:
+    def probe(head: bytes):
+        try:
+            rows = WeatherTable(path_io=io.BytesIO(head))
+            rows.load()
+        except Exception as e:
+            raise HTTPException(422, f"Unprocessable file {e}")
+        if _type == CsvTypes.input_data:
+            rows.validate()
+
+    return probe
+
+
+async def store_upload(user: Dict, metadata: CSVFileReqPyd, chunks: AsyncIterator[bytes]) -> CSVFile:
+    _id = uuid4()
+    codec = table_compression()
+    path = table_path(_id, 'csv', codec)
+    digest, tail = await ingest(chunks, temp_path(path), probe_upload(metadata.type), codec=codec)
+    try:
+        meta = await CSVFile.create(**metadata.dict(), id=_id, user=await get_current_user(user))
+    except Exception:
+        discard_files(temp_path(path))
+        raise
+    os.replace(temp_path(path), path)
+    blob = blobs.blob_path(digest, table_suffix('csv', codec))
+    if os.path.exists(blob):
+        blobs.adopt(blob, path)
+    else:
+        blobs.publish(path, blob)
+    save_digest(meta.id, digest)
+    save_tail(meta.id, newline=tail.endswith(b'\n'), last=tail_date(path, tail))
+    return meta
+
 
 async def load_csv_file(
         user: Annotated[Dict, Depends(permission_setter())],
         metadata: CSVFileReqPyd = Depends(),
         data: UploadFile = File(...)
 ):
-    try:
-        table = PandasTable(path_io=data.file)
-        table.load()
-    except Exception as e:
-        raise HTTPException(422, f"Unprocessable file {e}")
-    meta = await CSVFile.create(**metadata.dict(), user=await get_current_user(user))
-    table.path_io = f'data/csv/{meta.id}.csv'
-    table.save()
-    return meta
+    return await store_upload(user, metadata, file_chunks(data))
+
+
+async def stream_csv_file(
+        user: Annotated[Dict, Depends(permission_setter())],
+        request: Request,
+        metadata: CSVFileReqPyd = Depends(),
+):
+    return await store_upload(user, metadata, request.stream())
 
 
 async def get_csv_metas(
@@ -37,98 +254,360 @@ async def get_csv_metas(
     return csv
 
 
+def page_cursor(path: str, offset: int) -> str:
+    return f'{offset}.{os.stat(path).st_mtime_ns:x}'
+
+
+def cursor_offset(path: str, cursor: str) -> int:
+    offset, _, version = cursor.partition('.')
+    if not offset.isdigit():
+        raise HTTPException(400, f'malformed cursor: {cursor}')
+    if version != f'{os.stat(path).st_mtime_ns:x}':
+        raise HTTPException(409, 'table changed since the cursor was issued')
+    return int(offset)
+
+
 async def get_csv_json(
         user: Annotated[Dict, Depends(permission_setter())],
         id: str,
-        head: Optional[int] = 5
+        offset: Annotated[int, Query(ge=0)] = 0,
+        limit: Annotated[Optional[int], Query(ge=1)] = 5,
+        cursor: Optional[str] = None,
+        columns: Annotated[Optional[List[str]], Query()] = None,
 ):
     try:
         meta = (await CSVFile.filter(user=await get_current_user(user), id=id))[0]
-        table = PandasTable(path_io=f'data/csv/{meta.id}.csv')
-        table.load()
+        table = PandasTable(path_io=table_path(meta.id))
+        if cursor is not None:
+            offset = cursor_offset(table.path_io, cursor)
+        rows = table.page(offset, None if limit is None else limit + 1, columns)
+    except HTTPException:
+        raise
+    except KeyError as e:
+        raise HTTPException(422, f'{e}')
     except Exception as e:
         raise HTTPException(403, f'{e}')
-    table = json.loads(table.data.to_json(orient='records'))
-    return {'table_data': (table if head is None else table[:head]), 'meta': meta.__dict__}
+    has_next = limit is not None and len(rows) > limit
+    body = '{"table_data":%s,"next":%s,"meta":%s}' % (
+        rows.iloc[:limit].to_json(orient='records'),
+        json.dumps(page_cursor(table.path_io, offset + limit) if has_next else None),
+        json.dumps(jsonable_encoder(meta.__dict__)),
+    )
+    return Response(body, media_type='application/json')
+
+
+def proceed_options(windows: Optional[List[Tuple[int, int]]], compact: bool, chunksize: Optional[int]) -> Dict:
+    options = {'compact': compact, 'chunksize': chunksize}
+    if windows:
+        options['windows'] = tuple(map(tuple, windows))
+    return options
+
+
+def derived_table(meta: CSVFile, user: User, _type: CsvTypes) -> CSVFile:
+    return CSVFile(
+        id=uuid4(),
+        name=meta.name,
+        latitude=meta.latitude,
+        longitude=meta.longitude,
+        type=_type,
+        description=meta.description,
+        user=user,
+        csv_file_id=f"{meta.id}",
+    )
+
+
+async def commit_tables(tables: List[CSVFile], written: List[str]):
+    try:
+        async with in_transaction():
+            await CSVFile.bulk_create(tables)
+    except Exception:
+        discard_files(*map(temp_path, written))
+        raise
+    for path in written:
+        os.replace(temp_path(path), path)
+
+
+async def proceed_tables(
+        meta: CSVFile,
+        user: User,
+        options: Dict,
+        on_progress: Optional[Callable[[Dict], Awaitable]] = None,
+) -> List[CSVFile]:
+    async with INPUT_LOCKS[f'{meta.id}']:
+        storage, codec = derived_format()
+        tables = {name: derived_table(meta, user, _type) for name, _type in PRODUCT_TYPES.items()}
+        paths = {name: table_path(table.id, storage, codec) for name, table in tables.items()}
+        key = results_key(input_digest(meta.id), options)
+        results = {name: blobs.blob_path(f'{key}.{name}', table_suffix(storage, codec)) for name in PRODUCT_TYPES}
+        totals = blobs.blob_path(f'{key}.totals', '.pkl')
+        fd, staged = tempfile.mkstemp(dir='data/csv', suffix='.totals.pkl.tmp')
+        os.close(fd)
+        try:
+            if all(map(os.path.exists, results.values())) and valid_totals(totals):
+                # same input bytes and pipeline, so only the metadata is new
+                for name, path in paths.items():
+                    blobs.link_or_copy(results[name], temp_path(path))
+                blobs.adopt(totals, totals_path(meta.id, options))
+                if on_progress is not None:
+                    await on_progress({'stage': 'reused stored results', 'done': 1, 'total': 1})
+            else:
+                await jobs.run_in_pool(
+                    proceed_files,
+                    table_path(meta.id),
+                    {name: temp_path(path) for name, path in paths.items()},
+                    staged,
+                    on_progress=on_progress,
+                    storage=storage,
+                    compression=codec,
+                    **options,
+                )
+                os.replace(staged, totals_path(meta.id, options))
+        except Exception:
+            discard_files(*map(temp_path, paths.values()))
+            raise
+        finally:
+            discard_files(staged)
+        await commit_tables(list(tables.values()), list(paths.values()))
+        for name, path in paths.items():
+            blobs.publish(path, results[name])
+        blobs.publish(totals_path(meta.id, options), totals)
+        save_option_set(meta.id, options, list(tables.values()))
+        return list(tables.values())
 
 
 # assign_csvs
-async def proceed_csv(user: Annotated[Dict, Depends(permission_setter())], id: str, ):
-    async def create_table(_type: str, csv: CSVFile):
-        _table = await CSVFile.create(
-            name=meta.name,
-            latitude=meta.latitude,
-            longitude=meta.longitude,
-            type=_type,
-            description=meta.description,
-            user=await get_current_user(user),
-            csv_file_id=f"{csv}"
-        )
-        return _table
+async def proceed_csv(
+        user: Annotated[Dict, Depends(permission_setter())],
+        id: str,
+        windows: Optional[List[Tuple[int, int]]] = None,
+        compact: bool = False,
+        chunksize: Optional[int] = None,
+):
+    try:
+        user = await get_current_user(user)
+        meta = (await CSVFile.filter(user=user, id=id))[0]
+        return await proceed_tables(meta, user, proceed_options(windows, compact, chunksize))
+    except Exception as e:
+        raise HTTPException(422, f"Unprocessable file {e}")
+
 
+async def proceed_csv_job(
+        user: Annotated[Dict, Depends(permission_setter())],
+        id: str,
+        windows: Optional[List[Tuple[int, int]]] = None,
+        compact: bool = False,
+        chunksize: Optional[int] = None,
+):
+    user = await get_current_user(user)
     try:
-        meta = (await CSVFile.filter(user=await get_current_user(user), id=id))[0]
-        table = WeatherTable(path_io=f'data/csv/{meta.id}.csv')
-        table.load()
-
-        ky = await create_table("proceed_data_Ky", csv=meta.id)
-        ed = await create_table("proceed_data_Ed", csv=meta.id)
-        em = await create_table("proceed_data_Em", csv=meta.id)
-        gtk = await create_table("proceed_data_GTK", csv=meta.id)
-        mean_t_months = await create_table('proceed_data_mean_t_months', csv=meta.id)
-        active_months = await create_table('proceed_data_active_months', csv=meta.id)
-        decades_grouped = await create_table("proceed_data_decades_grouped", csv=meta.id)
-        em_active_months = await create_table('proceed_em_active_months', csv=meta.id)
-        grouped_year = await create_table('groups_year', csv=meta.id)
-
-        table.ky.to_csv(f'data/csv/{ky.id}.csv')
-        table.em.to_csv(f'data/csv/{em.id}.csv')
-        table.ed.to_csv(f'data/csv/{ed.id}.csv')
-        table.gtk.to_csv(f'data/csv/{gtk.id}.csv')
-        table.decades_grouped.to_csv(f'data/csv/{decades_grouped.id}.csv')
-        table.active_months.to_csv(f'data/csv/{active_months.id}.csv')
-        table.mean_t_months.to_csv(f'data/csv/{mean_t_months.id}.csv')
-        table.em_active_months.to_csv(f'data/csv/{em_active_months.id}.csv')
-        table.groupby_year.to_csv(f'data/csv/{grouped_year.id}.csv')
+        meta = (await CSVFile.filter(user=user, id=id))[0]
+    except Exception as e:
+        raise HTTPException(403, f'{e}')
+    task = await BackgroundTask.create(user=user, meta={'status': 'queued', 'csv_file_id': f'{meta.id}'})
+    jobs.spawn(run_proceed_job(task, meta, user, proceed_options(windows, compact, chunksize)))
+    return await BackgroundTaskResp.from_tortoise_orm(task)
+
+
+async def run_proceed_job(task: BackgroundTask, meta: CSVFile, user: User, options: Dict):
+    async def on_progress(progress: Dict):
+        await update_task(task, status='running', **progress)
+
+    try:
+        tables = await proceed_tables(meta, user, options, on_progress)
+    except Exception as e:
+        await update_task(task, status='failed', error=f'{e}')
+    else:
+        await update_task(task, status='done', result=[f'{table.id}' for table in tables])
+
+
+async def option_groups(meta: CSVFile, user: User) -> Tuple[Dict[str, Tuple[Dict, Dict[str, List[CSVFile]]]], List[CSVFile], List[CSVFile]]:
+    derived = {f'{table.id}': table for table in await CSVFile.filter(user=user, csv_file_id=meta.id)}
+    groups = {}
+    for key, (options, ids) in option_sets(meta.id).items():
+        for _id in ids:
+            table = derived.pop(_id, None)
+            if table is not None and table.type in PRODUCT_NAMES:
+                groups.setdefault(key, (options, {}))[1].setdefault(PRODUCT_NAMES[table.type], []).append(table)
+    unclaimed = [table for table in derived.values() if table.type in PRODUCT_NAMES]
+    if groups and not unclaimed:
+        return groups, [], []
+    # tables proceeded before option sets were recorded are taken as proceeded with the defaults
+    options = option_set({})
+    tables = groups.setdefault(options_key(options), (options, {}))[1]
+    for table in unclaimed:
+        tables.setdefault(PRODUCT_NAMES[table.type], []).append(table)
+    new = [derived_table(meta, user, _type) for name, _type in PRODUCT_TYPES.items() if name not in tables]
+    for table in new:
+        tables[PRODUCT_NAMES[table.type]] = [table]
+    return groups, new, [*unclaimed, *new]
 
+
+async def append_csv(
+        user: Annotated[Dict, Depends(permission_setter())],
+        id: str,
+        data: UploadFile = File(...),
+):
+    user = await get_current_user(user)
+    try:
+        meta = (await CSVFile.filter(user=user, id=id, type=CsvTypes.input_data))[0]
     except Exception as e:
         raise HTTPException(422, f"Unprocessable file {e}")
-    return [
-        ky,
-        ed,
-        em,
-        gtk,
-        mean_t_months,
-        active_months,
-        decades_grouped,
-        em_active_months,
-        grouped_year,
-    ]
-
-
-async def get_proceed(user: Annotated[Dict, Depends(permission_setter())], id: str, ) -> StreamingResponse:
+
+    fd, upload = tempfile.mkstemp(dir='data/csv', suffix='.csv.tmp')
+    os.close(fd)
+    async with INPUT_LOCKS[f'{meta.id}']:
+        try:
+            await ingest(file_chunks(data), upload, probe_upload(CsvTypes.input_data))
+            return await append_tables(meta, user, upload)
+        finally:
+            discard_files(upload)
+
+
+async def append_tables(meta: CSVFile, user: User, upload: str) -> List[CSVFile]:
+    storage, codec = derived_format()
+    groups, new, claimed = await option_groups(meta, user)
+    sets, written, stale, totals = [], [], [], []
+    for options, tables in groups.values():
+        outputs = {}
+        for name, derived in tables.items():
+            for table in derived:
+                written.append(table_path(table.id, storage, codec))
+                stale.append(table_path(table.id))
+                outputs.setdefault(name, []).append(temp_path(written[-1]))
+        totals.append(totals_path(meta.id, options))
+        sets.append((table_options(options), outputs, totals[-1], temp_path(totals[-1])))
     try:
-        tables = await CSVFile.filter(user=await get_current_user(user), csv_file_id=id)
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, False) as zip_file:
-            for table in tables:
-                csv = PandasTable(path_io=f'data/csv/{table.id}.csv')
-                csv.load()
-                csv_buffer = io.BytesIO()
-                csv.data.to_csv(csv_buffer, index=False)
-                csv_buffer.seek(0)
-                zip_file.writestr(f'{table.date_created}_{table.id}_{table.type}.csv', csv_buffer.getvalue())
-        zip_buffer.seek(0)
-        headers = {
-            'Content-Disposition': f'attachment; filename="{id}.zip"'
-        }
-        return StreamingResponse(zip_buffer, headers=headers)
+        stored = load_tail(meta.id)
+        last = await jobs.run_in_pool(
+            append_files,
+            table_path(meta.id),
+            upload,
+            sets,
+            stored.get('newline'),
+            stored.get('last'),
+            chunksize=APPEND_CHUNKSIZE,
+            storage=storage,
+            compression=codec,
+        )
+    except HTTPException:
+        discard_files(*map(temp_path, [*written, *totals]))
+        raise
+    except Exception as e:
+        discard_files(*map(temp_path, [*written, *totals]))
+        raise HTTPException(422, f"Unprocessable file {e}")
+    discard_files(digest_path(meta.id))
+    # every appended member ends with a newline
+    save_tail(meta.id, newline=True, last=last)
+    for path in totals:
+        os.replace(temp_path(path), path)
+    await commit_tables(new, written)
+    if claimed:
+        save_option_set(meta.id, option_set({}), claimed)
+    # tables stored in another format are migrated on rewrite
+    discard_files(*(old for old in stale if old not in written))
+    discard_map_archives(*{
+        table.map_id
+        for _, tables in groups.values()
+        for derived in tables.values()
+        for table in derived
+        if table.map_id is not None
+    })
+    return [table for _, tables in groups.values() for derived in tables.values() for table in derived]
+
+
+def csv_source(path: str) -> Union[str, Iterator[bytes]]:
+    if columnar.is_columnar(path):
+        return columnar.iter_csv(path)
+    if codec_of(path) is not None:
+        return iter_bytes(path)
+    return path
+
+
+def accepts_encoding(header: str, codec: str) -> bool:
+    weights = {}
+    for token in header.split(','):
+        name, *params = [part.strip() for part in token.split(';')]
+        weight = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        if name:
+            weights[name.lower()] = weight
+    return weights.get(codec, weights.get('*', 0.0)) > 0
+
 
+async def get_csv_file(
+        user: Annotated[Dict, Depends(permission_setter())],
+        request: Request,
+        id: str,
+):
+    try:
+        meta = (await CSVFile.filter(user=await get_current_user(user), id=id))[0]
+        path = table_path(meta.id)
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+    except Exception as e:
+        raise HTTPException(403, f'{e}')
+    headers = {'Content-Disposition': f'attachment; filename="{meta.id}.csv"', 'Vary': 'Accept-Encoding'}
+    codec = codec_of(path)
+    if codec is not None and accepts_encoding(request.headers.get('accept-encoding', ''), codec):
+        # stored bytes are already what the client asked for
+        return FileResponse(path, media_type='text/csv', headers={**headers, 'Content-Encoding': codec})
+    source = csv_source(path)
+    if isinstance(source, str):
+        return FileResponse(source, media_type='text/csv', headers=headers)
+    return StreamingResponse(source, media_type='text/csv', headers=headers)
+
+
+async def get_storage_report(user: Annotated[Dict, Depends(permission_setter())]):
+    report = {}
+    for meta in await CSVFile.filter(user=await get_current_user(user)):
+        path = table_path(meta.id)
+        if not os.path.exists(path):
+            continue
+        kind = 'columnar' if columnar.is_columnar(path) else codec_of(path) or 'csv'
+        usage = report.setdefault(kind, {'files': 0, 'bytes': 0})
+        usage['files'] += 1
+        usage['bytes'] += os.path.getsize(path)
+    return {'storage': report, 'total_bytes': sum(usage['bytes'] for usage in report.values())}
+
+
+async def get_cache_stats(user: Annotated[Dict, Depends(permission_setter())]):
+    return TABLE_CACHE.stats()
+
+
+async def get_proceed(
+        user: Annotated[Dict, Depends(permission_setter())],
+        id: str,
+        level: Annotated[int, Query(ge=0, le=9)] = 6,
+) -> StreamingResponse:
+    try:
+        tables = await CSVFile.filter(user=await get_current_user(user), csv_file_id=id)
+        paths = {table: table_path(table.id) for table in tables}
+        for path in paths.values():
+            if not os.path.exists(path):
+                raise FileNotFoundError(path)
+        entries = [
+            (f'{table.date_created}_{table.id}_{table.type}.csv', csv_source(path))
+            for table, path in paths.items()
+        ]
     except Exception as e:
         raise HTTPException(403, f'{e}')
+    headers = {
+        'Content-Disposition': f'attachment; filename="{id}.zip"'
+    }
+    return StreamingResponse(stream_zip(entries, level), media_type='application/zip', headers=headers)
 
 
-async def assign_tables_to_map(user: Annotated[Dict, Depends(permission_setter())], map_id: str, csv_ids: list[str]):
+async def assign_tables_to_map(user: Annotated[Dict, Depends(permission_setter())], map_id: UUID, csv_ids: list[str]):
     user = await get_current_user(user)
-    return await CSVFile.filter(user=user, csv_file_id__in=csv_ids).update(map_id=map_id)
+    tables = CSVFile.filter(user=user, csv_file_id__in=csv_ids)
+    previous = await tables.filter(map_id__isnull=False).distinct().values_list('map_id', flat=True)
+    updated = await tables.update(map_id=map_id)
+    discard_map_archives(map_id, *previous)
+    return updated
 
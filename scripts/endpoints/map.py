@@ -1,20 +1,37 @@
+import asyncio
+import hashlib
 import io
+import json
+import os
+import tempfile
 import zipfile
-from typing import Annotated, Dict
+from concurrent.futures import Future, as_completed
+from contextlib import suppress
+from typing import Annotated, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple
+from uuid import UUID
 
 import folium
+import numpy as np
 import pandas as pd
-from fastapi import Depends
-from folium.plugins import HeatMap, MarkerCluster
-from starlette.responses import StreamingResponse
+from fastapi import Depends, Request
+from folium.plugins import HeatMap, HeatMapWithTime, MarkerCluster
+from starlette.responses import FileResponse, Response, StreamingResponse
 
+from scripts.endpoints.csv_file import discard_files, map_archive_dir, table_path
+from scripts.endpoints.task import archive_path, update_task
+from scripts.shared import blobs, jobs
+from scripts.shared.archive import stream_zip
 from scripts.shared.user import get_current_user
-from scripts.models.api import MapReqPyd
-from scripts.models.enums import CsvTypes
-from scripts.models.pg import Map, CSVFile
+from scripts.models.api import BackgroundTaskResp, MapReqPyd
+from scripts.models.enums import CsvTypes, MapLayouts
+from scripts.models.pg import BackgroundTask, Map, CSVFile
+from scripts.shared.cache import file_version
 from scripts.shared.lab_tools import PandasTable
 from scripts.shared.security import permission_setter
 
+# bump whenever rendered maps change, cached archives are keyed by it
+RENDER_VERSION = 1
+
 
 async def create_map(data: MapReqPyd, user: Annotated[Dict, Depends(permission_setter())]):
     return await Map.create(**data.dict(), user=await get_current_user(user))
@@ -24,22 +41,29 @@ async def get_maps_meta(user: Annotated[Dict, Depends(permission_setter())],):
     return await Map.filter(user=await get_current_user(user)).order_by('date_created')
 
 
-def visualize_map(df, year, io):
-    data_year = df[df['DATE'] == year]
-    map_center = [data_year['latitude'].mean(), data_year['longitude'].mean()]
-    my_map = folium.Map(location=map_center, zoom_start=2)
-    heat_data = [[row['latitude'], row['longitude'], row['T2M']] for index, row in data_year.iterrows()]
+def visualize_map(data_year: pd.DataFrame, io):
+    latitude = data_year['latitude'].to_numpy()
+    longitude = data_year['longitude'].to_numpy()
+    my_map = folium.Map(location=[latitude.mean(), longitude.mean()], zoom_start=2)
+    heat_data = np.column_stack([latitude, longitude, data_year['T2M'].to_numpy()]).tolist()
     HeatMap(heat_data, name='T2M', blur=16).add_to(my_map)
     marker_cluster = MarkerCluster(name='PRECTOTCORR').add_to(my_map)
-    for index, row in data_year.iterrows():
+    precipitation = data_year['PRECTOTCORR']
+    radii = (precipitation.to_numpy(dtype=float) - precipitation.mean()) / 10
+    for lat, lon, radius, name in zip(
+            latitude.tolist(),
+            longitude.tolist(),
+            radii.tolist(),
+            data_year['name'].tolist(),
+    ):
         folium.CircleMarker(
-            location=[row['latitude'], row['longitude']],
-            radius=(row['PRECTOTCORR'] - data_year['PRECTOTCORR'].mean()) / 10,
+            location=[lat, lon],
+            radius=radius,
             color='blue',
             fill=True,
             fill_color='blue',
             fill_opacity=1,
-            tooltip=row['name']
+            tooltip=name
         ).add_to(marker_cluster)
 
     folium.LayerControl().add_to(my_map)
@@ -47,9 +71,117 @@ def visualize_map(df, year, io):
     my_map.save(io, close_file=False)
 
 
-async def proceed_maps(user: Annotated[Dict, Depends(permission_setter())], map_id: str, ):
-    user = await get_current_user(user)
-    tables = await CSVFile.filter(user=user, map_id=map_id, type=CsvTypes.groups_year)
+def visualize_timeline(df: pd.DataFrame, io, precision: int = 4):
+    # one document for all years: the heat layer is time-indexed and the assets are embedded once
+    index, heat_data = [], []
+    for year, data_year in df.groupby('DATE'):
+        index.append(str(year))
+        heat_data.append(np.column_stack([
+            data_year['latitude'].to_numpy(),
+            data_year['longitude'].to_numpy(),
+            data_year['T2M'].to_numpy(),
+        ]).round(precision).tolist())
+    stations = df.drop_duplicates(['name', 'latitude', 'longitude'])
+    my_map = folium.Map(location=[stations['latitude'].mean(), stations['longitude'].mean()], zoom_start=2)
+    HeatMapWithTime(heat_data, index=index, name='T2M', radius=16).add_to(my_map)
+    marker_cluster = MarkerCluster(name='stations').add_to(my_map)
+    for lat, lon, name in zip(
+            stations['latitude'].tolist(),
+            stations['longitude'].tolist(),
+            stations['name'].tolist(),
+    ):
+        folium.CircleMarker(location=[lat, lon], radius=4, color='blue', tooltip=name).add_to(marker_cluster)
+
+    folium.LayerControl().add_to(my_map)
+
+    my_map.save(io, close_file=False)
+
+
+def render_year(year, data_year: pd.DataFrame) -> Tuple[str, bytes]:
+    buffer = io.BytesIO()
+    visualize_map(data_year, io=buffer)
+    return f'{year}.html', buffer.getvalue()
+
+
+def render_timeline(df: pd.DataFrame) -> Tuple[str, bytes]:
+    buffer = io.BytesIO()
+    visualize_timeline(df, io=buffer)
+    return 'timeline.html', buffer.getvalue()
+
+
+def submit_maps(df: pd.DataFrame, layout: MapLayouts = MapLayouts.years) -> List[Future]:
+    if layout == MapLayouts.slider:
+        return [jobs.submit(render_timeline, df, workers='MAP_WORKERS')]
+    return [
+        jobs.submit(render_year, year, data_year, workers='MAP_WORKERS')
+        for year, data_year in df.groupby('DATE', sort=False)
+    ]
+
+
+def rendered_maps(df: pd.DataFrame, layout: MapLayouts = MapLayouts.years) -> Iterator[Tuple[str, bytes]]:
+    # a plain generator, starlette drains it in a worker thread so waiting here never blocks the loop
+    futures = submit_maps(df, layout)
+    try:
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+async def render_archive(
+        df: pd.DataFrame,
+        path: str,
+        layout: MapLayouts = MapLayouts.years,
+        on_progress: Optional[Callable[[Dict], Awaitable]] = None,
+):
+    futures = submit_maps(df, layout)
+    try:
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, False) as zip_file:
+            for done, future in enumerate(asyncio.as_completed([asyncio.wrap_future(f) for f in futures]), 1):
+                name, html = await future
+                await asyncio.to_thread(zip_file.writestr, name, html)
+                if on_progress is not None:
+                    await on_progress({'stage': f'rendered {name}', 'done': done, 'total': len(futures)})
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def archive_key(map_id: UUID, tables: List[CSVFile], layout: MapLayouts) -> str:
+    versions = sorted((f'{table.id}', file_version(table_path(table.id))) for table in tables)
+    return hashlib.sha256(json.dumps([RENDER_VERSION, f'{map_id}', layout.value, versions]).encode()).hexdigest()
+
+
+def cached_archive(map_id: UUID, key: str) -> str:
+    return f'{map_archive_dir(map_id)}/{key}.zip'
+
+
+def cache_archive(chunks: Iterator[bytes], path: str) -> Iterator[bytes]:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        # the map may have been invalidated while rendering, the archive is dropped then
+        with suppress(FileNotFoundError):
+            os.replace(tmp, path)
+    finally:
+        discard_files(tmp)
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    tags = {tag.strip() for tag in request.headers.get('if-none-match', '').split(',')}
+    return etag in tags or '*' in tags
+
+
+async def map_tables(user, map_id: UUID) -> List[CSVFile]:
+    return await CSVFile.filter(user=user, map_id=map_id, type=CsvTypes.groups_year)
+
+
+async def map_frame(tables: List[CSVFile]) -> pd.DataFrame:
     main_table = (await CSVFile.filter(id__in=list(map(lambda x: x.csv_file_id, tables))))[0]
 
     latitude = main_table.latitude
@@ -57,24 +189,110 @@ async def proceed_maps(user: Annotated[Dict, Depends(permission_setter())], map_
     df_lst = []
     name = main_table.name
     for table in tables:
-        csv = PandasTable(path_io=f'data/csv/{table.id}.csv')
+        csv = PandasTable(path_io=table_path(table.id))
         csv.load()
         csv['name'] = name
         csv['latitude'] = latitude
         csv['longitude'] = longitude
         df_lst.append(csv)
 
-    df = pd.concat([i.data for i in df_lst])
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, False) as zip_file:
-        for year in df['DATE'].tolist():
-            buffer = io.BytesIO()
-            visualize_map(df, year=year, io=buffer)
-            buffer.seek(0)
+    return pd.concat([i.data for i in df_lst])
+
 
-            zip_file.writestr(f'{year}.html', buffer.getvalue())
-    zip_buffer.seek(0)
+async def proceed_maps(
+        user: Annotated[Dict, Depends(permission_setter())],
+        request: Request,
+        map_id: UUID,
+        layout: MapLayouts = MapLayouts.years,
+):
+    user = await get_current_user(user)
+    tables = await map_tables(user, map_id)
+    key = archive_key(map_id, tables, layout)
+    path = cached_archive(map_id, key)
     headers = {
-        'Content-Disposition': f'attachment; filename="{map_id}.zip"'
+        'Content-Disposition': f'attachment; filename="{map_id}.zip"',
+        'ETag': f'"{key}"',
+        'Cache-Control': 'private, no-cache',
     }
-    return StreamingResponse(zip_buffer, headers=headers)
+    if os.path.exists(path):
+        if etag_matches(request, headers['ETag']):
+            return Response(status_code=304, headers={'ETag': headers['ETag']})
+        return FileResponse(path, media_type='application/zip', headers=headers)
+    df = await map_frame(tables)
+    return StreamingResponse(
+        cache_archive(stream_zip(rendered_maps(df, layout)), path),
+        media_type='application/zip',
+        headers=headers,
+    )
+
+
+async def proceed_maps_job(
+        user: Annotated[Dict, Depends(permission_setter())],
+        map_id: UUID,
+        layout: MapLayouts = MapLayouts.years,
+):
+    user = await get_current_user(user)
+    tables = await map_tables(user, map_id)
+    cached = cached_archive(map_id, archive_key(map_id, tables, layout))
+    df = None if os.path.exists(cached) else await map_frame(tables)
+    task = await BackgroundTask.create(user=user, meta={'status': 'queued', 'map_id': f'{map_id}', 'layout': layout})
+    jobs.spawn(run_maps_job(task, df, cached, layout))
+    return await BackgroundTaskResp.from_tortoise_orm(task)
+
+
+async def run_maps_job(
+        task: BackgroundTask,
+        df: Optional[pd.DataFrame],
+        cached: str,
+        layout: MapLayouts = MapLayouts.years,
+):
+    async def on_progress(progress: Dict):
+        await update_task(task, status='running', **progress)
+
+    try:
+        os.makedirs(os.path.dirname(archive_path(task.id)), exist_ok=True)
+        if df is None:
+            blobs.link_or_copy(cached, archive_path(task.id))
+        else:
+            await render_archive(df, archive_path(task.id), layout, on_progress=on_progress)
+            blobs.publish(archive_path(task.id), cached)
+    except Exception as e:
+        await update_task(task, status='failed', error=f'{e}')
+    else:
+        await update_task(
+            task,
+            status='done',
+            result=[task.meta['map_id']],
+            archive=f'/api/task/result?id={task.id}',
+        )
+
+if __name__ == '__main__':
+    import time
+
+    stations, years = 30, 40
+    rng = np.random.default_rng(0)
+    frame = pd.concat([
+        pd.DataFrame({
+            'DATE': np.arange(1981, 1981 + years),
+            'T2M': rng.normal(10, 5, years),
+            'PRECTOTCORR': rng.gamma(2, 300, years),
+            'name': f'station {station}',
+            'latitude': rng.uniform(40, 60),
+            'longitude': rng.uniform(20, 90),
+        })
+        for station in range(stations)
+    ])
+    for workers in sorted({1, 2, 4, os.cpu_count() or 1}):
+        os.environ['MAP_WORKERS'] = str(workers)
+        jobs.get_pool.cache_clear()
+        # start the workers first so only rendering is timed
+        list(rendered_maps(frame.head(workers)))
+        st = time.perf_counter()
+        archive = b''.join(stream_zip(rendered_maps(frame)))
+        print(f'{workers} workers: {time.perf_counter() - st:.2f}s, {len(archive)} bytes for {stations} stations x {years} years')
+        jobs.get_pool('MAP_WORKERS').shutdown()
+    jobs.get_pool.cache_clear()
+    list(rendered_maps(frame.head(1), MapLayouts.slider))
+    st = time.perf_counter()
+    archive = b''.join(stream_zip(rendered_maps(frame, MapLayouts.slider)))
+    print(f'slider layout: {time.perf_counter() - st:.2f}s, {len(archive)} bytes for {stations} stations x {years} years')
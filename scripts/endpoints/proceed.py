@@ -1,15 +1,55 @@
-from contextlib import suppress
-from datetime import datetime
+import os
+from dataclasses import dataclass
 from functools import cached_property
+from pathlib import Path
+from queue import Queue
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Tuple, Union
 
 import pandas as pd
 from fastapi import HTTPException
 
-from scripts.shared import lab_tools
-from scripts.shared.lab_tools import PandasTable, groupy_date
+from scripts.shared import blobs, columnar, lab_tools
+from scripts.shared.compression import codec_of, last_byte, open_writer, pandas_compression
+from scripts.shared.lab_tools import PandasTable, Product
 
+SEASON_WINDOWS = (
+    (5, 6),
+    (5, 7),
+    (5, 8),
+    (1, 12),
+)
 
+STREAMED_TOTALS = ('month_totals', 'decade_totals')
+
+# bump whenever a product's output changes, stored results are keyed by it
+PIPELINE_VERSION = 5
+
+MONTH_FORMAT = '%Y/%m/01'
+
+COMPACT_SCHEMA = {
+    'YEAR': 'int16',
+    'MO': 'int8',
+    'DY': 'int8',
+    'T2M': 'float32',
+    'PRECTOTCORR': 'float32',
+    'RH2M': 'float32',
+}
+
+
+@dataclass
 class WeatherTable(PandasTable):
+    strict: bool = True
+    windows: Tuple[Tuple[int, int], ...] = SEASON_WINDOWS
+    compact: bool = False
+    chunksize: Optional[int] = None
+    # raw uploads are parsed once per proceed, caching them only crowds out hot tables
+    cached: bool = False
+
+    def __post_init__(self):
+        if self.compact:
+            self.dtype = COMPACT_SCHEMA
+            self.usecols = list(COMPACT_SCHEMA)
+
     @cached_property
     def need_cols(self):
         return 'YEAR,MO,DY,T2M,PRECTOTCORR,RH2M'.split(',')
@@ -19,145 +59,315 @@ class WeatherTable(PandasTable):
         return len(self.need_cols)
 
     @cached_property
-    def ord_normal(self):
-        ord_df = lab_tools.PandasTable(
-            data=self.data.copy()
-        )
-        ord_df.data['DATE'] = ord_df.data['YEAR,MO,DY'.split(',')].apply(
-            lambda x: pd.to_datetime(f"{x['YEAR']}/{x['MO']}/{x['DY']}", yearfirst=True, ), axis=1)
-        ord_df.data = ord_df.data.drop('YEAR,MO,DY'.split(','), axis=1)
-        return ord_df.data
+    def keys(self) -> Tuple[str, ...]:
+        return ()
 
     @cached_property
-    def groupby_year(self):
-        ord_df_group = self.ord_normal.copy()
-        return ord_df_group.groupby(
-            ord_df_group['DATE'].dt.year,
-        ).agg({'PRECTOTCORR': 'sum', 'T2M': 'mean'}).reset_index()
+    def graph(self) -> Dict[str, Product]:
+        return {
+            'ord_normal': Product(self.ord_normal, ('data',)),
+            'groupby_year': Product(self.groupby_year, ('month_totals',)),
+            'decades': Product(self.decades, ('ord_normal',)),
+            'decade_totals': Product(self.decade_totals, ('ord_normal', 'decades')),
+            'decades_grouped': Product(self.decades_grouped, ('decade_totals',)),
+            'ed': Product(self.ed, ('decades_grouped',)),
+            'month_totals': Product(self.month_totals, ('ord_normal',)),
+            'mean_t_months': Product(self.mean_t_months, ('month_totals',)),
+            'em': Product(self.em, ('mean_t_months',)),
+            'monthly': Product(self.monthly, ('month_totals',)),
+            'active_months': Product(self.active_months, ('monthly',)),
+            'gtk': Product(self.gtk, ('active_months',)),
+            'em_active_months': Product(self.em_active_months, ('em',)),
+            'ky': Product(self.ky, ('em_active_months', 'active_months')),
+        }
 
-    @cached_property
-    def decades(self):
-        ord_df = lab_tools.PandasTable(
-            data=self.ord_normal.copy(),
-        )
-        ord_df.data['DECADE'] = ord_df['DATE'].apply(lambda x: f"{lab_tools.create_decade(x)}", )
-        return ord_df.data
+    def load(self):
+        if self.chunksize is None:
+            super().load()
 
-    @cached_property
-    def decades_grouped(self):
-        ord_df = lab_tools.PandasTable(
-            data=self.decades.copy()
+    def chunks(self) -> Iterator[pd.DataFrame]:
+        if self.chunksize is None:
+            return iter([self.read()])
+        return pd.read_csv(
+            self.path_io,
+            dtype=self.dtype,
+            usecols=self.usecols,
+            chunksize=self.chunksize,
+            compression=codec_of(self.path_io),
         )
-        return ord_df.data.groupby(['DECADE']).aggregate({'T2M': 'mean', 'PRECTOTCORR': 'sum', 'RH2M': 'mean'})
+
+    def streamed_totals(self) -> Dict[str, pd.DataFrame]:
+        totals = {}
+        for chunk in self.chunks():
+            for name, part in lab_tools.run_products(self.graph, *STREAMED_TOTALS, data=chunk):
+                totals[name] = lab_tools.merge_totals(totals[name], part) if name in totals else part
+        return totals
+
+    def products(
+            self,
+            *names: str,
+            progress: Optional[Callable[[str, int, int], Any]] = None,
+            **sources,
+    ) -> Iterator[Tuple[str, pd.DataFrame]]:
+        if not sources:
+            sources = {'data': self.data} if self.chunksize is None else self.streamed_totals()
+        return lab_tools.run_products(self.graph, *names, progress=progress, **sources)
+
+    @staticmethod
+    def check_totals(totals: Dict[str, pd.DataFrame]):
+        if missing := [name for name in STREAMED_TOTALS if name not in totals]:
+            raise ValueError(f'totals are missing {missing}')
+
+    def save_totals(self, totals: Dict[str, pd.DataFrame], path_io: Union[str, Path, os.PathLike]):
+        self.check_totals(totals)
+        pd.to_pickle({'windows': self.windows, 'compact': self.compact, **totals}, path_io)
+
+    @classmethod
+    def load_totals(
+            cls,
+            path_io: Union[str, Path, os.PathLike],
+            **options,
+    ) -> Tuple['WeatherTable', Dict[str, pd.DataFrame]]:
+        totals = pd.read_pickle(path_io)
+        cls.check_totals(totals)
+        return cls(windows=totals.pop('windows'), compact=totals.pop('compact', False), **options), totals
+
+    def compute(self, *names: str) -> Dict[str, pd.DataFrame]:
+        return dict(self.products(*names))
+
+    def write(self, frame: pd.DataFrame, path_io: Union[str, Path, os.PathLike]):
+        last = frame.index.levels[-1] if isinstance(frame.index, pd.MultiIndex) else frame.index
+        if isinstance(last, pd.PeriodIndex):
+            frame = frame.set_axis(lab_tools.relabel_last_level(
+                frame.index,
+                lambda x: x.strftime(MONTH_FORMAT).rename(x.name),
+            ))
+        # stored bytes are served as is, so an anonymous positional index is not written
+        frame = frame.reset_index(drop=all(name is None for name in frame.index.names))
+        if self.storage == 'columnar':
+            columnar.write_frame(frame, path_io)
+        else:
+            frame.to_csv(path_io, index=False, compression=pandas_compression(self.compression))
 
     def validate(self):
         passed = self.data.columns
         if len(frozenset(passed) & frozenset(self.need_cols)) < self.need_cols_len:
             raise HTTPException(406, f'incorect columns, passed: {passed}, need: {self.need_cols}')
+        if invalid := [col for col in COMPACT_SCHEMA if not pd.api.types.is_numeric_dtype(self.data[col])]:
+            raise HTTPException(422, f'non-numeric values in columns: {invalid}')
+        try:
+            lab_tools.assemble_date(self.data, strict=self.strict)
+        except ValueError as e:
+            raise HTTPException(422, f'{e}')
 
-    @cached_property
-    def mean_t_months(self):
-        ord_df = lab_tools.PandasTable(
-            data=self.ord_normal.copy(),
-        )
-        with suppress(Exception):
-            ord_df.data['DATE'] = ord_df.data['DATE'].apply(lambda x: datetime.strptime(x, '%Y-%m-%d'), )
-        ord_df['DATE'] = ord_df.data['DATE'].apply(
-            lambda x: f'{x.year}/{x.month if x.month > 9 else "0" + str(x.month)}/01'
+    def ord_normal(self, data: pd.DataFrame) -> pd.DataFrame:
+        ord_df = data.drop('YEAR,MO,DY'.split(','), axis=1)
+        ord_df['DATE'] = lab_tools.assemble_date(data, strict=self.strict)
+        return ord_df.dropna(subset=['DATE']) if not self.strict else ord_df
+
+    def groupby_year(self, month_totals: pd.DataFrame) -> pd.DataFrame:
+        return lab_tools.combine_totals(
+            month_totals.groupby(level=[*self.keys, 'DATE']).sum(),
+            PRECTOTCORR='sum',
+            T2M='mean',
+        ).reset_index()
+
+    @staticmethod
+    def decades(ord_normal: pd.DataFrame) -> pd.Series:
+        return lab_tools.decade_key(ord_normal['DATE']).rename('DECADE')
+
+    def decade_totals(self, ord_normal: pd.DataFrame, decades: pd.Series) -> pd.DataFrame:
+        return ord_normal.groupby(
+            [*(ord_normal[key] for key in self.keys), decades],
+        )[['T2M', 'PRECTOTCORR', 'RH2M']].agg(['sum', 'count'])
+
+    @staticmethod
+    def decades_grouped(decade_totals: pd.DataFrame) -> pd.DataFrame:
+        df = lab_tools.combine_totals(decade_totals, T2M='mean', PRECTOTCORR='sum', RH2M='mean')
+        df.index = lab_tools.relabel_last_level(df.index, lab_tools.decade_label)
+        return df
+
+    def month_totals(self, ord_normal: pd.DataFrame) -> pd.DataFrame:
+        return lab_tools.monthly_aggregates(ord_normal, 'DATE', 'T2M', 'PRECTOTCORR', 'RH2M', by=self.keys)
+
+    @staticmethod
+    def mean_t_months(month_totals: pd.DataFrame) -> pd.DataFrame:
+        return lab_tools.aggregate_months(month_totals, T2M='mean', PRECTOTCORR='sum', RH2M='mean')
+
+    @staticmethod
+    def monthly(month_totals: pd.DataFrame) -> pd.DataFrame:
+        return lab_tools.cumulative_months(month_totals)
+
+    def active_months(self, monthly: pd.DataFrame) -> pd.DataFrame:
+        return lab_tools.aggregate_windows(
+            monthly,
+            self.windows,
+            T2M='sum',
+            PRECTOTCORR='sum',
+            RH2M='mean',
         )
-        ord_df.data = ord_df.data.groupby(['DATE']).aggregate(
-            {'T2M': 'mean', 'PRECTOTCORR': 'sum', 'RH2M': 'mean'})
-        return ord_df.data
 
-    @cached_property
-    def active_months(self):
-        ord_df = PandasTable(
-            data=self.ord_normal.copy(),
+    def gtk(self, active_months: pd.DataFrame) -> pd.DataFrame:
+        return pd.concat([active_months, pd.DataFrame({
+            f'GTK_{_st}_{_end}':
+                active_months[f'PRECTOTCORR_between_{_st}_{_end}_months']
+                / (0.1 * active_months[f'T2M_between_{_st}_{_end}_months'])
+            for _st, _end in self.windows
+        })], axis=1)
+
+    @staticmethod
+    def ed(decades_grouped: pd.DataFrame) -> pd.DataFrame:
+        df = decades_grouped[['T2M', 'PRECTOTCORR', 'RH2M']]
+        return df.assign(**{'Ед': 0.061 * (25 + df.T2M) / (1 - 0.01 * df.RH2M)})
+
+    @staticmethod
+    def em(mean_t_months: pd.DataFrame) -> pd.DataFrame:
+        df = mean_t_months[['T2M', 'PRECTOTCORR', 'RH2M']]
+        return df.assign(Em=0.018 * (25 + df.T2M) ** 2 / (100 - df.RH2M))
+
+    def em_active_months(self, em: pd.DataFrame) -> pd.DataFrame:
+        # a year is kept when any window has a month above 10 degrees, windows without one are NaN
+        em_df = em.loc[em['T2M'] > 10].reset_index()
+        monthly = lab_tools.cumulative_months(
+            lab_tools.monthly_aggregates(em_df, 'DATE', 'Em', 'PRECTOTCORR', by=self.keys),
+        )
+        return lab_tools.aggregate_windows(
+            monthly,
+            self.windows,
+            Em='sum',
+            PRECTOTCORR='sum',
         )
 
-        groups = PandasTable(data=pd.DataFrame(), )
-
-        for _st, _end in (
-                (5, 6),
-                (5, 7),
-                (5, 8),
-                (1, 12),
-        ):
-            gr = groupy_date(
-                ord_df.data,
-                date_cols='DATE',
-                st=_st,
-                end=_end,
-                T2M='sum',
-                PRECTOTCORR='sum',
-                RH2M='mean',
-            )
-            groups.data[gr.columns] = gr
-        return groups.data
+    def ky(self, em_active_months: pd.DataFrame, active_months: pd.DataFrame) -> pd.DataFrame:
+        # assign aligns on em_active_months, years without a month above 10 degrees stay out
+        return em_active_months.assign(**{
+            f'Ky_{_st}_{_end}':
+                active_months[f'PRECTOTCORR_between_{_st}_{_end}_months']
+                / em_active_months[f'Em_between_{_st}_{_end}_months']
+            for _st, _end in self.windows
+        })
 
-    @cached_property
-    def gtk(self):
-        df = self.active_months.copy()
-        df['GTK_5_6'] = df['PRECTOTCORR_between_5_6_months'] / (0.1 * df['T2M_between_5_6_months'])
-        df['GTK_5_7'] = df['PRECTOTCORR_between_5_7_months'] / (0.1 * df['T2M_between_5_7_months'])
-        df['GTK_5_8'] = df['PRECTOTCORR_between_5_8_months'] / (0.1 * df['T2M_between_5_8_months'])
-        df['GTK_1_12'] = df['PRECTOTCORR_between_1_12_months'] / (0.1 * df['T2M_between_1_12_months'])
-        return df
 
-    @cached_property
-    def ed(self):
-        df = self.decades_grouped.copy()
-        df = df[['T2M', 'PRECTOTCORR', 'RH2M']]
-        df['Ед'] = 0.061 * (25 + df.T2M) / (1 - 0.01 * df.RH2M)
-        return df
+@dataclass
+class WeatherPanel(WeatherTable):
+    station_col: str = 'STATION'
 
     @cached_property
-    def em(self):
-        df = self.mean_t_months.copy()
-        df = df[['T2M', 'PRECTOTCORR', 'RH2M']]
-        df['Em'] = 0.018 * (25 + df.T2M) ** 2 / (100 - df.RH2M)
-        return df
+    def need_cols(self):
+        return [self.station_col, *super().need_cols]
 
     @cached_property
-    def em_active_months(self):
-        em_df = PandasTable(
-            data=self.em.reset_index(),
-        )
-        em_df.data['DATE'] = em_df.data['DATE'].apply(lambda x: datetime.strptime(x, '%Y/%m/%d'), )
-        groups = PandasTable(data=pd.DataFrame(), )
-        # lab_tools.ds_view(em_df.data.head(1000))
-
-        for _st, _end in (
-                (5, 6),
-                (5, 7),
-                (5, 8),
-                (1, 12),
-        ):
-            gr = groupy_date(
-                em_df.data.loc[em_df['T2M'] > 10],
-                date_cols='DATE',
-                st=_st,
-                end=_end,
-                # T2M='sum',
-                # RH2M='mean',
-                Em='sum',
-                PRECTOTCORR='sum',
-            )
-            groups.data[gr.columns] = gr
-        return groups.data
+    def keys(self) -> Tuple[str, ...]:
+        return self.station_col,
 
-    @cached_property
-    def ky(self):
-        df = self.em_active_months.copy()
-        df_pr = self.active_months.copy()
-        df['Ky_5_6'] = df_pr['PRECTOTCORR_between_5_6_months'] / df['Em_between_5_6_months']
-        df['Ky_5_7'] = df_pr['PRECTOTCORR_between_5_7_months'] / df['Em_between_5_7_months']
-        df['Ky_5_8'] = df_pr['PRECTOTCORR_between_5_8_months'] / df['Em_between_5_8_months']
-        df['Ky_1_12'] = df_pr['PRECTOTCORR_between_1_12_months'] / df['Em_between_1_12_months']
-        return df
+    def split(self, frame: pd.DataFrame) -> Iterator[Tuple[Any, pd.DataFrame]]:
+        if self.station_col in frame.columns:
+            for station, part in frame.groupby(self.station_col, sort=False):
+                yield station, part.drop(columns=self.station_col).reset_index(drop=True)
+        else:
+            for station, part in frame.groupby(level=self.station_col, sort=False):
+                yield station, part.droplevel(self.station_col)
+
+
+def proceed_files(
+        path_io: Union[str, Path, os.PathLike],
+        outputs: Dict[str, str],
+        totals_io: Union[str, Path, os.PathLike],
+        progress: Optional[Queue] = None,
+        **options,
+):
+    def report(stage: str, done: int, total: int):
+        if progress is not None:
+            progress.put({'stage': stage, 'done': done, 'total': total})
+
+    table = WeatherTable(path_io=path_io, **options)
+    table.load()
+    totals = {}
+    for name, frame in table.products(
+            *outputs,
+            *STREAMED_TOTALS,
+            progress=lambda stage, done, total: report(f'{stage} done', done, total),
+    ):
+        if name in outputs:
+            report(f'writing {name}', list(outputs).index(name) + 1, len(outputs))
+            table.write(frame, outputs[name])
+        else:
+            totals[name] = frame
+    table.save_totals(totals, totals_io)
+
+
+def date_key(frame: pd.DataFrame) -> pd.Series:
+    return frame['YEAR'].astype('int64') * 10000 + frame['MO'].astype('int64') * 100 + frame['DY'].astype('int64')
+
+
+def last_date(path_io: Union[str, Path, os.PathLike], chunksize: Optional[int] = None) -> List[int]:
+    table = WeatherTable(path_io=path_io, usecols=['YEAR', 'MO', 'DY'], chunksize=chunksize)
+    for chunk in table.chunks():
+        last = chunk.iloc[-1]
+    return [int(last[col]) for col in ('YEAR', 'MO', 'DY')]
+
+
+def append_files(
+        path_io: Union[str, Path, os.PathLike],
+        rows_io: Union[str, Path, os.PathLike, BinaryIO],
+        sets: List[Tuple[Dict, Dict[str, List[str]], str, str]],
+        newline: Optional[bool] = None,
+        last: Optional[List[int]] = None,
+        progress: Optional[Queue] = None,
+        chunksize: Optional[int] = None,
+        **options,
+) -> List[int]:
+    rows = WeatherTable(path_io=rows_io)
+    rows.load()
+    rows.validate()
+    if rows.data.empty:
+        raise HTTPException(422, 'no rows to append')
+    year, month, day = last_date(path_io, chunksize) if last is None else last
+    keys = date_key(rows.data)
+    if overlap := int((keys <= year * 10000 + month * 100 + day).sum()):
+        raise HTTPException(409, f'{overlap} appended rows fall on or before the last stored date {year}-{month:02}-{day:02}')
+    merged = []
+    for set_options, outputs, totals_io, totals_out in sets:
+        if os.path.exists(totals_io):
+            table, totals = WeatherTable.load_totals(totals_io, **options)
+            data = rows.data[table.usecols].astype(table.dtype) if table.compact else rows.data
+            totals = {
+                name: lab_tools.merge_totals(totals[name], part)
+                for name, part in table.products(*STREAMED_TOTALS, data=data)
+            }
+        else:
+            table = WeatherTable(path_io=path_io, chunksize=chunksize, **set_options, **options)
+            totals = None
+        merged.append((table, totals, outputs, totals_out))
+
+    header = pd.read_csv(path_io, nrows=0, compression=codec_of(path_io)).columns
+    appended = rows.data.reindex(columns=header.drop('Unnamed: 0', errors='ignore')).to_csv(
+        header=False,
+        index='Unnamed: 0' in header,
+    ).encode()
+    # uploads are stored as sent and may lack the final newline, inputs stored before it was recorded are read once
+    if newline is None:
+        newline = last_byte(path_io) in (b'', b'\n')
+    if not newline:
+        appended = b'\n' + appended
+    blobs.unshare(path_io)
+    with open_writer(path_io, codec_of(path_io), 'ab') as f:
+        f.write(appended)
+
+    for done, (table, totals, outputs, totals_out) in enumerate(merged, 1):
+        if totals is None:
+            totals = table.streamed_totals()
+        table.save_totals(totals, totals_out)
+        for name, frame in table.products(*outputs, **totals):
+            for output in outputs[name]:
+                table.write(frame, output)
+        if progress is not None:
+            progress.put({'stage': 'option set appended', 'done': done, 'total': len(merged)})
+    newest = int(keys.max())
+    return [newest // 10000, newest // 100 % 100, newest % 100]
 
 
 if __name__ == '__main__':
     weather = WeatherTable(path_io='/home/urumchi/py/analytics/ORD.csv')
     weather.load()
-    print(weather.groupby_year)
+    print(weather.compute('groupby_year')['groupby_year'])
@@ -0,0 +1,69 @@
+import asyncio
+import json
+import os
+from typing import Annotated, AsyncIterator, Dict
+
+from fastapi import Depends, HTTPException
+from starlette.responses import FileResponse, StreamingResponse
+
+from scripts.models.api import BackgroundTaskResp
+from scripts.models.pg import BackgroundTask
+from scripts.shared import jobs
+from scripts.shared.security import permission_setter
+from scripts.shared.user import get_current_user
+
+FINAL_STATUSES = ('done', 'failed')
+
+KEEPALIVE_SECONDS = 15
+
+
+async def update_task(task: BackgroundTask, **meta):
+    task.meta = {**task.meta, **meta}
+    await task.save()
+    jobs.publish(task.id, task.meta)
+
+
+def archive_path(task_id: int) -> str:
+    return f'data/zip/{task_id}.zip'
+
+
+def sse_event(meta: Dict) -> str:
+    event = meta['status'] if meta.get('status') in FINAL_STATUSES else 'progress'
+    return f'event: {event}\ndata: {json.dumps(meta)}\n\n'
+
+
+async def user_task(user: Dict, id: int) -> BackgroundTask:
+    try:
+        return (await BackgroundTask.filter(user=await get_current_user(user), id=id))[0]
+    except Exception as e:
+        raise HTTPException(403, f'{e}')
+
+
+async def get_task(user: Annotated[Dict, Depends(permission_setter())], id: int):
+    return await BackgroundTaskResp.from_tortoise_orm(await user_task(user, id))
+
+
+async def stream_task(user: Annotated[Dict, Depends(permission_setter())], id: int) -> StreamingResponse:
+    task = await user_task(user, id)
+
+    async def events() -> AsyncIterator[str]:
+        with jobs.subscribe(task.id) as queue:
+            await task.refresh_from_db(fields=['meta'])
+            meta = task.meta
+            yield sse_event(meta)
+            while meta.get('status') not in FINAL_STATUSES:
+                try:
+                    meta = await asyncio.wait_for(queue.get(), KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                else:
+                    yield sse_event(meta)
+
+    return StreamingResponse(events(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+async def get_task_result(user: Annotated[Dict, Depends(permission_setter())], id: int) -> FileResponse:
+    task = await user_task(user, id)
+    if task.meta.get('status') != 'done' or not os.path.exists(archive_path(task.id)):
+        raise HTTPException(404, f'no archive for task {task.id}')
+    return FileResponse(archive_path(task.id), filename=f'{task.id}.zip')
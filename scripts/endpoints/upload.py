@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+from typing import Annotated, AsyncIterator, Dict, List, Optional
+
+from fastapi import Depends, HTTPException, Query, Request
+from fastapi.encoders import jsonable_encoder
+
+from scripts.endpoints.csv_file import discard_files, store_upload
+from scripts.models.api import CSVFileReqPyd
+from scripts.models.pg import UploadSession
+from scripts.shared.ingest import CHUNK_SIZE, upload_limit
+from scripts.shared.security import permission_setter
+from scripts.shared.user import get_current_user
+
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def session_dir(session_id) -> str:
+    return f'data/upload/{session_id}'
+
+
+def part_path(session_id, index: int) -> str:
+    return f'{session_dir(session_id)}/{index}.part'
+
+
+def received_parts(session_id) -> List[int]:
+    with os.scandir(session_dir(session_id)) as entries:
+        return sorted(int(entry.name[:-len('.part')]) for entry in entries if entry.name.endswith('.part'))
+
+
+def session_state(session: UploadSession) -> Dict:
+    return {
+        'id': f'{session.id}',
+        'chunk_size': session.chunk_size,
+        'size': session.size,
+        'received': received_parts(session.id),
+    }
+
+
+async def user_session(user: Dict, id: str) -> UploadSession:
+    try:
+        return (await UploadSession.filter(user=await get_current_user(user), id=id))[0]
+    except Exception as e:
+        raise HTTPException(403, f'{e}')
+
+
+async def create_upload(
+        user: Annotated[Dict, Depends(permission_setter())],
+        metadata: CSVFileReqPyd = Depends(),
+        chunk_size: Annotated[int, Query(ge=CHUNK_SIZE)] = DEFAULT_CHUNK_SIZE,
+        size: Annotated[Optional[int], Query(ge=1)] = None,
+):
+    if size is not None and size > upload_limit():
+        raise HTTPException(413, f'file is larger than {upload_limit()} bytes')
+    session = await UploadSession.create(
+        user=await get_current_user(user),
+        meta=jsonable_encoder(metadata.dict()),
+        chunk_size=chunk_size,
+        size=size,
+    )
+    os.makedirs(session_dir(session.id), exist_ok=True)
+    return session_state(session)
+
+
+async def get_upload(user: Annotated[Dict, Depends(permission_setter())], id: str):
+    return session_state(await user_session(user, id))
+
+
+async def put_upload_chunk(
+        user: Annotated[Dict, Depends(permission_setter())],
+        request: Request,
+        id: str,
+        index: Annotated[int, Query(ge=0)],
+):
+    session = await user_session(user, id)
+    if index * session.chunk_size >= upload_limit():
+        raise HTTPException(413, f'file is larger than {upload_limit()} bytes')
+    path = part_path(session.id, index)
+    written = 0
+    # each attempt writes its own file, so a retry racing a stalled one never shares its bytes
+    fd, tmp = tempfile.mkstemp(dir=session_dir(session.id), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            async for chunk in request.stream():
+                written += len(chunk)
+                if written > session.chunk_size:
+                    raise HTTPException(413, f'chunk is larger than {session.chunk_size} bytes')
+                f.write(chunk)
+    except BaseException:
+        discard_files(tmp)
+        raise
+    # a retried chunk simply replaces the previous copy
+    os.replace(tmp, path)
+    return {'index': index, 'size': written}
+
+
+async def session_chunks(session: UploadSession, parts: List[int]) -> AsyncIterator[bytes]:
+    for index in parts:
+        with open(part_path(session.id, index), 'rb') as f:
+            while chunk := f.read(CHUNK_SIZE):
+                yield chunk
+
+
+async def finalize_upload(user: Annotated[Dict, Depends(permission_setter())], id: str):
+    session = await user_session(user, id)
+    parts = received_parts(session.id)
+    count = len(parts) if session.size is None else -(-session.size // session.chunk_size)
+    if missing := sorted(frozenset(range(max(count, parts[-1] + 1 if parts else 1))) - frozenset(parts)):
+        raise HTTPException(409, f'missing chunks: {missing}')
+    sizes = [os.path.getsize(part_path(session.id, index)) for index in parts]
+    if any(size != session.chunk_size for size in sizes[:-1]):
+        raise HTTPException(409, 'only the last chunk may be shorter than chunk_size')
+    if session.size is not None and sum(sizes) != session.size:
+        raise HTTPException(409, f'received {sum(sizes)} bytes, expected {session.size}')
+    meta = await store_upload(user, CSVFileReqPyd(**session.meta), session_chunks(session, parts))
+    await session.delete()
+    shutil.rmtree(session_dir(session.id), ignore_errors=True)
+    return meta
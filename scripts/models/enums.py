@@ -12,3 +12,8 @@ class CsvTypes(str, Enum):
     proceed_data_active_months = 'proceed_data_active_months'
     proceed_em_active_months = 'proceed_em_active_months'
     groups_year = 'groups_year'
+
+
+class MapLayouts(str, Enum):
+    years = 'years'
+    slider = 'slider'
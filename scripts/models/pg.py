@@ -36,6 +36,15 @@ class BackgroundTask(models.Model):
     user = fields.ForeignKeyField('pg.User')
     meta = fields.JSONField(null=True)
 
+
+class UploadSession(models.Model):
+    id = fields.UUIDField(pk=True)
+    user = fields.ForeignKeyField('pg.User')
+    meta = fields.JSONField()
+    chunk_size = fields.IntField()
+    size = fields.BigIntField(null=True)
+    date_created = fields.DatetimeField(auto_now=True)
+
 # class MapCSVFile(models.Model):
 #     id = fields.UUIDField(pk=True)
 #     map = fields.ForeignKeyField('pg.Map')
@@ -0,0 +1,54 @@
+import io
+import os
+import zipfile
+from typing import Iterable, Iterator, Tuple, Union
+
+CHUNK_SIZE = 1 << 16
+
+
+class ZipStream(io.RawIOBase):
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def pop(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def zip_mode(level: int) -> dict:
+    if level == 0:
+        return {'compression': zipfile.ZIP_STORED}
+    return {'compression': zipfile.ZIP_DEFLATED, 'compresslevel': level}
+
+
+def stream_zip(
+        entries: Iterable[Tuple[str, Union[str, os.PathLike, bytes, Iterable[bytes]]]],
+        level: int = 6,
+        chunk_size: int = CHUNK_SIZE,
+) -> Iterator[bytes]:
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', **zip_mode(level)) as zip_file:
+        for arcname, source in entries:
+            with zip_file.open(arcname, 'w', force_zip64=True) as dst:
+                if isinstance(source, bytes):
+                    dst.write(source)
+                elif isinstance(source, (str, os.PathLike)):
+                    with open(source, 'rb') as src:
+                        while chunk := src.read(chunk_size):
+                            dst.write(chunk)
+                            yield stream.pop()
+                else:
+                    for chunk in source:
+                        dst.write(chunk)
+                        yield stream.pop()
+            yield stream.pop()
+    yield stream.pop()
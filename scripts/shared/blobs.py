@@ -0,0 +1,49 @@
+import hashlib
+import os
+import shutil
+from contextlib import suppress
+from typing import Iterable
+
+BLOB_DIR = 'data/blob'
+
+
+def blob_path(key: str, suffix: str = '') -> str:
+    return f'{BLOB_DIR}/{key}{suffix}'
+
+
+def digest(chunks: Iterable[bytes]) -> str:
+    sha = hashlib.sha256()
+    for chunk in chunks:
+        sha.update(chunk)
+    return sha.hexdigest()
+
+
+def link_or_copy(src: str, dst: str):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def publish(path: str, blob: str):
+    # keeps the first copy of a content key, later identical files are dropped
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    if os.path.exists(blob):
+        return
+    with suppress(FileExistsError):
+        link_or_copy(path, blob)
+
+
+def adopt(blob: str, path: str):
+    # replaces `path` (usually a freshly written duplicate) with a link to the blob
+    tmp = f'{path}.link'
+    link_or_copy(blob, tmp)
+    os.replace(tmp, path)
+
+
+def unshare(path: str):
+    # gives `path` its own inode before it is modified in place
+    if os.stat(path).st_nlink > 1:
+        tmp = f'{path}.unshared'
+        shutil.copyfile(path, tmp)
+        os.replace(tmp, path)
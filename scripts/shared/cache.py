@@ -0,0 +1,139 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from contextlib import suppress
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+import pandas as pd
+
+from scripts.shared import columnar
+
+
+def file_version(path_io) -> Optional[Tuple[int, int, int]]:
+    if not isinstance(path_io, (str, os.PathLike)):
+        return None
+    try:
+        stat = os.stat(path_io)
+    except OSError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def frame_size(frame: pd.DataFrame) -> int:
+    return int(frame.memory_usage(deep=True, index=True).sum())
+
+
+@dataclass
+class FrameCache:
+    entries: 'OrderedDict[Hashable, Tuple[pd.DataFrame, int]]' = field(default_factory=OrderedDict)
+    size: int = 0
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    disk_hits: int = 0
+    disk_evictions: int = 0
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @property
+    def budget(self) -> int:
+        return int(os.getenv('TABLE_CACHE_BYTES', 256 * 1024 * 1024))
+
+    @property
+    def disk_dir(self) -> Optional[str]:
+        return os.getenv('TABLE_CACHE_DIR') or None
+
+    @property
+    def disk_budget(self) -> int:
+        return int(os.getenv('TABLE_CACHE_DIR_BYTES', 1024 * 1024 * 1024))
+
+    def get(self, key: Hashable, loader: Callable[[], pd.DataFrame]) -> pd.DataFrame:
+        if not self.budget:
+            return loader()
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0].copy()
+            self.misses += 1
+        frame = self.load_disk(key)
+        if frame is None:
+            frame = loader()
+            self.save_disk(key, frame)
+        self.put(key, frame)
+        # callers are free to mutate what they get, the cached frame stays intact
+        return frame.copy()
+
+    def put(self, key: Hashable, frame: pd.DataFrame):
+        size = frame_size(frame)
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            if size <= self.budget:
+                self.entries[key] = frame, size
+                self.size += size
+            while self.size > self.budget:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+
+    def disk_path(self, key: Hashable) -> Optional[str]:
+        if self.disk_dir is None:
+            return None
+        return f'{self.disk_dir}/{hashlib.sha256(repr(key).encode()).hexdigest()}.col'
+
+    def load_disk(self, key: Hashable) -> Optional[pd.DataFrame]:
+        path = self.disk_path(key)
+        if path is None:
+            return None
+        try:
+            # the mtime orders the disk sweep, so a hit marks the file as recently used
+            os.utime(path)
+            frame = columnar.read_frame(path)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            self.disk_hits += 1
+        return frame
+
+    def save_disk(self, key: Hashable, frame: pd.DataFrame):
+        path = self.disk_path(key)
+        # the columnar format keeps columns only, so indexed frames stay in memory
+        if path is None or not isinstance(frame.index, pd.RangeIndex) or frame.index.start != 0:
+            return
+        os.makedirs(self.disk_dir, exist_ok=True)
+        columnar.write_frame(frame, f'{path}.tmp')
+        os.replace(f'{path}.tmp', path)
+        self.sweep_disk()
+
+    def sweep_disk(self):
+        # keys carry the file version, so entries of rewritten tables are never hit again and age out here
+        with os.scandir(self.disk_dir) as entries:
+            stats = [(entry.stat(), entry.path) for entry in entries if entry.name.endswith('.col')]
+        files = sorted((stat.st_mtime_ns, stat.st_size, path) for stat, path in stats)
+        size = sum(file_size for _, file_size, _ in files)
+        for _, file_size, path in files:
+            if size <= self.disk_budget:
+                break
+            with suppress(FileNotFoundError):
+                os.remove(path)
+            size -= file_size
+            with self.lock:
+                self.disk_evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'budget': self.budget,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'disk_hits': self.disk_hits,
+                'disk_evictions': self.disk_evictions,
+            }
+
+
+TABLE_CACHE = FrameCache()
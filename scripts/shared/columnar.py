@@ -0,0 +1,122 @@
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+MAGIC = b'WTCOL1\n'
+
+ALIGN = 64
+
+CSV_CHUNK_ROWS = 100_000
+
+
+def aligned(offset: int) -> int:
+    return -(-offset // ALIGN) * ALIGN
+
+
+def is_columnar(path_io) -> bool:
+    if not isinstance(path_io, (str, Path, os.PathLike)):
+        return False
+    try:
+        with open(path_io, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def column_arrays(frame: pd.DataFrame) -> Dict[str, Tuple[np.ndarray, Optional[np.ndarray]]]:
+    arrays = {}
+    for name, col in frame.items():
+        values, nulls = col.to_numpy(), None
+        if values.dtype == object:
+            # strings are stored fixed-width, so missing values are kept apart in a mask
+            nulls = pd.isna(values)
+            values = np.where(nulls, '', values).astype(str)
+            nulls = np.ascontiguousarray(nulls) if nulls.any() else None
+        arrays[str(name)] = np.ascontiguousarray(values), nulls
+    return arrays
+
+
+def write_frame(frame: pd.DataFrame, path_io: Union[str, Path, os.PathLike]):
+    arrays = column_arrays(frame)
+    columns, blocks, offset = [], [], 0
+    for name, (values, nulls) in arrays.items():
+        column = {'name': name, 'dtype': values.dtype.str}
+        for key, block in (('offset', values), ('nulls', nulls)):
+            if block is not None:
+                offset = aligned(offset)
+                column[key] = offset
+                blocks.append((offset, block))
+                offset += block.nbytes
+        columns.append(column)
+    header = json.dumps({'rows': len(frame), 'columns': columns}).encode()
+    start = aligned(len(MAGIC) + 8 + len(header))
+    with open(path_io, 'wb') as f:
+        f.write(MAGIC)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        for block_offset, block in blocks:
+            f.seek(start + block_offset)
+            f.write(block.data)
+        f.truncate(start + offset)
+
+
+def read_header(path_io: Union[str, Path, os.PathLike]) -> Tuple[Dict, int]:
+    with open(path_io, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path_io} is not a columnar table')
+        size = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(size))
+    return header, aligned(len(MAGIC) + 8 + size)
+
+
+def column_names(path_io: Union[str, Path, os.PathLike]) -> List[str]:
+    return [column['name'] for column in read_header(path_io)[0]['columns']]
+
+
+def read_columns(
+        path_io: Union[str, Path, os.PathLike],
+        columns: Optional[List[str]] = None,
+        rows: slice = slice(None),
+) -> Dict[str, np.ndarray]:
+    header, start = read_header(path_io)
+    info = {column['name']: column for column in header['columns']}
+    if columns is None:
+        columns = list(info)
+    elif missing := [col for col in columns if col not in info]:
+        raise KeyError(f'unknown columns: {missing}, available: {list(info)}')
+    if not header['rows']:
+        return {name: np.empty(0, dtype=info[name]['dtype']) for name in columns}
+    arrays = {}
+    for name in columns:
+        values = np.memmap(
+            path_io,
+            dtype=info[name]['dtype'],
+            mode='r',
+            offset=start + info[name]['offset'],
+            shape=(header['rows'],),
+        )[rows]
+        if 'nulls' in info[name]:
+            nulls = np.memmap(path_io, dtype=bool, mode='r', offset=start + info[name]['nulls'], shape=(header['rows'],))
+            values = values.astype(object)
+            values[nulls[rows]] = None
+        arrays[name] = values
+    return arrays
+
+
+def read_frame(
+        path_io: Union[str, Path, os.PathLike],
+        columns: Optional[List[str]] = None,
+        rows: slice = slice(None),
+) -> pd.DataFrame:
+    return pd.DataFrame(read_columns(path_io, columns, rows))
+
+
+def iter_csv(path_io: Union[str, Path, os.PathLike], chunk_rows: int = CSV_CHUNK_ROWS) -> Iterator[bytes]:
+    rows = read_header(path_io)[0]['rows']
+    for start in range(0, max(rows, 1), chunk_rows):
+        frame = read_frame(path_io, rows=slice(start, start + chunk_rows))
+        yield frame.to_csv(index=False, header=not start).encode()
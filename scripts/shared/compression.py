@@ -0,0 +1,72 @@
+import gzip
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import BinaryIO, Iterator, Optional, Union
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# level 1 is ~6x faster than 6 on weather text for ~15% larger files
+GZIP_LEVEL = 1
+
+CHUNK_SIZE = 1 << 16
+
+
+def table_compression() -> Optional[str]:
+    return os.getenv('TABLE_COMPRESSION', 'gzip') or None
+
+
+def codec_of(path_io) -> Optional[str]:
+    if not isinstance(path_io, (str, Path, os.PathLike)):
+        return None
+    try:
+        with open(path_io, 'rb') as f:
+            return 'gzip' if f.read(len(GZIP_MAGIC)) == GZIP_MAGIC else None
+    except OSError:
+        return None
+
+
+def pandas_compression(codec: Optional[str]):
+    if codec == 'gzip':
+        return {'method': 'gzip', 'compresslevel': GZIP_LEVEL, 'mtime': 0}
+    return None
+
+
+@contextmanager
+def open_writer(path_io: Union[str, Path, os.PathLike], codec: Optional[str], mode: str = 'wb') -> Iterator[BinaryIO]:
+    with open(path_io, mode) as raw:
+        if codec == 'gzip':
+            # a new member per write session, so appends stay valid multi-member gzip
+            with gzip.GzipFile(filename='', mode=mode, fileobj=raw, compresslevel=GZIP_LEVEL, mtime=0) as f:
+                yield f
+        else:
+            yield raw
+
+
+@contextmanager
+def open_reader(path_io: Union[str, Path, os.PathLike]) -> Iterator[BinaryIO]:
+    if codec_of(path_io) == 'gzip':
+        with gzip.open(path_io, 'rb') as f:
+            yield f
+    else:
+        with open(path_io, 'rb') as f:
+            yield f
+
+
+def iter_bytes(path_io: Union[str, Path, os.PathLike], chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    with open_reader(path_io) as f:
+        while chunk := f.read(chunk_size):
+            yield chunk
+
+
+def last_byte(path_io: Union[str, Path, os.PathLike]) -> bytes:
+    if codec_of(path_io) is None:
+        with open(path_io, 'rb') as f:
+            if not f.seek(0, os.SEEK_END):
+                return b''
+            f.seek(-1, os.SEEK_END)
+            return f.read(1)
+    last = b''
+    for chunk in iter_bytes(path_io):
+        last = chunk[-1:]
+    return last
@@ -0,0 +1,68 @@
+import asyncio
+import hashlib
+import os
+from contextlib import suppress
+from typing import AsyncIterator, Callable, Optional, Tuple
+
+from fastapi import HTTPException, UploadFile
+
+from scripts.shared.compression import open_writer
+
+CHUNK_SIZE = 1 << 16
+
+PROBE_ROWS = 100
+
+PROBE_BYTES = 1 << 20
+
+TAIL_BYTES = 4096
+
+
+def upload_limit() -> int:
+    return int(os.getenv('UPLOAD_MAX_BYTES', 512 * 1024 * 1024))
+
+
+async def file_chunks(file: UploadFile, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    while chunk := await file.read(chunk_size):
+        yield chunk
+
+
+async def ingest(
+        chunks: AsyncIterator[bytes],
+        path: str,
+        probe: Callable[[bytes], None],
+        max_bytes: Optional[int] = None,
+        probe_rows: int = PROBE_ROWS,
+        probe_bytes: int = PROBE_BYTES,
+        codec: Optional[str] = None,
+) -> Tuple[str, bytes]:
+    max_bytes = upload_limit() if max_bytes is None else max_bytes
+    size, lines, head, tail, sha = 0, 0, bytearray(), b'', hashlib.sha256()
+    try:
+        with open_writer(path, codec) as f:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(413, f'file is larger than {max_bytes} bytes')
+                if head is not None:
+                    head += chunk
+                    lines += chunk.count(b'\n')
+                    if lines > probe_rows:
+                        probe(bytes(head[:head.rindex(b'\n') + 1]))
+                        head = None
+                    elif len(head) > probe_bytes:
+                        raise HTTPException(
+                            422,
+                            f'Unprocessable file: the header and first {probe_rows} rows exceed {probe_bytes} bytes',
+                        )
+                sha.update(chunk)
+                tail = (tail + chunk)[-TAIL_BYTES:]
+                await asyncio.to_thread(f.write, chunk)
+        if not size:
+            raise HTTPException(422, 'Unprocessable file: empty upload')
+        if head is not None:
+            probe(bytes(head))
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.remove(path)
+        raise
+    return sha.hexdigest(), tail
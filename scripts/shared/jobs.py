@@ -0,0 +1,90 @@
+import asyncio
+import os
+from collections import defaultdict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import lru_cache, partial
+from multiprocessing import Manager
+from typing import Any, Awaitable, Callable, Coroutine, Dict, Hashable, Iterator, Optional, Set
+
+_RUNNING: Set[asyncio.Task] = set()
+
+_WATCHERS: Dict[Hashable, Set[asyncio.Queue]] = defaultdict(set)
+
+
+@lru_cache
+def get_pool(workers: str = 'PROCEED_WORKERS') -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=int(os.getenv(workers, os.cpu_count() or 1)))
+
+
+@lru_cache
+def get_manager():
+    return Manager()
+
+
+async def run_in_pool(
+        func: Callable,
+        *args,
+        on_progress: Optional[Callable[[Any], Awaitable]] = None,
+        poll: float = 0.2,
+        **kwargs,
+):
+    loop = asyncio.get_running_loop()
+    queue = get_manager().Queue() if on_progress is not None else None
+    try:
+        future = loop.run_in_executor(get_pool(), partial(func, *args, progress=queue, **kwargs))
+    except BrokenProcessPool:
+        get_pool.cache_clear()
+        raise
+    while queue is not None:
+        done = future.done()
+        while not queue.empty():
+            await on_progress(queue.get_nowait())
+        if done:
+            break
+        await asyncio.wait({future}, timeout=poll)
+    try:
+        return await future
+    except BrokenProcessPool:
+        get_pool.cache_clear()
+        raise
+
+
+def reset_if_broken(future: Future):
+    if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+        get_pool.cache_clear()
+
+
+def submit(func: Callable, *args, workers: str = 'PROCEED_WORKERS', **kwargs) -> Future:
+    try:
+        future = get_pool(workers).submit(func, *args, **kwargs)
+    except BrokenProcessPool:
+        get_pool.cache_clear()
+        raise
+    future.add_done_callback(reset_if_broken)
+    return future
+
+
+def spawn(coro: Coroutine) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _RUNNING.add(task)
+    task.add_done_callback(_RUNNING.discard)
+    return task
+
+
+def publish(key: Hashable, event: Any):
+    for queue in _WATCHERS.get(key, ()):
+        queue.put_nowait(event)
+
+
+@contextmanager
+def subscribe(key: Hashable) -> Iterator[asyncio.Queue]:
+    queue = asyncio.Queue()
+    _WATCHERS[key].add(queue)
+    try:
+        yield queue
+    finally:
+        _WATCHERS[key].discard(queue)
+        if not _WATCHERS[key]:
+            del _WATCHERS[key]
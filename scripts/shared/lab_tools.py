@@ -1,18 +1,24 @@
 import os
 import re
 import time
+from collections import Counter
 from contextlib import suppress
 from dataclasses import dataclass
 from datetime import datetime
 from functools import wraps
 from inspect import signature
 from pathlib import Path
-from typing import Any, Callable, List, Union, Optional
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple, Union, Optional
 
+import numpy as np
 import pandas as pd
 from requests import request
 from tabulate import tabulate
 
+from scripts.shared import columnar
+from scripts.shared.cache import TABLE_CACHE, file_version
+from scripts.shared.compression import codec_of, pandas_compression
+
 
 def separated_print(*args: Any) -> None:
     print(*args, end='\n\n')
@@ -66,6 +72,130 @@ def groupy_date(
     )
 
 
+def monthly_aggregates(df: pd.DataFrame, date_col: str, *cols: str, by: Iterable[str] = ()) -> pd.DataFrame:
+    dates = df[date_col]
+    return df.groupby(
+        [*(df[key] for key in by), dates.dt.year.rename(date_col), dates.dt.month.rename('month')],
+    )[list(cols)].agg(['sum', 'count'])
+
+
+def merge_totals(*parts: pd.DataFrame) -> pd.DataFrame:
+    totals = pd.concat(parts)
+    return totals.groupby(level=list(range(totals.index.nlevels))).sum()
+
+
+def relabel_last_level(index: pd.Index, func: Callable[[pd.Index], pd.Index]) -> pd.Index:
+    if isinstance(index, pd.MultiIndex):
+        return index.set_levels(func(index.levels[-1]), level=-1, verify_integrity=False)
+    return func(index)
+
+
+def year_range(index: pd.Index) -> pd.Index:
+    years = index.get_level_values(-1)
+    if index.nlevels == 1:
+        return pd.RangeIndex(years.min(), years.max() + 1, name=index.names[-1])
+    keys = list(range(index.nlevels - 1))
+    bounds = pd.Series(years, index=index.droplevel(-1)).groupby(level=keys).agg(['min', 'max'])
+    lengths = (bounds['max'] - bounds['min'] + 1).to_numpy()
+    offsets = np.arange(lengths.sum()) - np.repeat(lengths.cumsum() - lengths, lengths)
+    return pd.MultiIndex.from_arrays(
+        [
+            *(bounds.index.get_level_values(i).repeat(lengths) for i in keys),
+            np.repeat(bounds['min'].to_numpy(), lengths) + offsets,
+        ],
+        names=index.names,
+    )
+
+
+def cumulative_months(monthly: pd.DataFrame) -> pd.DataFrame:
+    table = monthly.unstack('month', fill_value=0)
+    columns = pd.MultiIndex.from_product(
+        [table.columns.levels[0], table.columns.levels[1], range(13)],
+        names=[None, None, 'month'],
+    )
+    table = table.reindex(index=year_range(table.index), columns=columns, fill_value=0)
+    # month 0 is an all-zero column, so a window st..end is cum[end] - cum[st - 1]
+    cumulative = table.to_numpy().reshape(len(table), -1, 13).cumsum(axis=2)
+    return pd.DataFrame(cumulative.reshape(len(table), -1), index=table.index, columns=columns)
+
+
+def window_totals(cumulative: pd.DataFrame, st: int, end: int) -> pd.DataFrame:
+    if not (1 <= st <= 12 and 1 <= end <= 12):
+        raise ValueError(f'months must be between 1 and 12, passed: {st}-{end}')
+
+    def at(month: int) -> pd.DataFrame:
+        return cumulative.xs(month, axis=1, level='month')
+
+    if st <= end:
+        return at(end) - at(st - 1)
+    # cross-year window, labelled by the year it ends in
+    tail = at(12) - at(st - 1)
+    observed = at(12).xs('count', axis=1, level=1).sum(axis=1) > 0
+    if cumulative.index.nlevels > 1:
+        keys = list(range(cumulative.index.nlevels - 1))
+        tail, observed = tail.groupby(level=keys), observed.groupby(level=keys)
+    # a year whose previous year has no data would only hold the Jan..end part, it is left out as NaN
+    return tail.shift(1).where(observed.shift(1, fill_value=False), axis=0) + at(end)
+
+
+def combine_totals(totals: pd.DataFrame, **aggr_funcs) -> pd.DataFrame:
+    if not frozenset(aggr_funcs.values()) <= {'sum', 'mean'}:
+        raise ValueError(f'only sum and mean can be derived from monthly aggregates, passed: {aggr_funcs}')
+    return pd.DataFrame({
+        k: totals[(k, 'sum')] / totals[(k, 'count')] if func == 'mean' else totals[(k, 'sum')]
+        for k, func in aggr_funcs.items()
+    })
+
+
+def aggregate_months(monthly: pd.DataFrame, **aggr_funcs) -> pd.DataFrame:
+    df = combine_totals(monthly, **aggr_funcs)
+    periods = pd.PeriodIndex(
+        year=monthly.index.get_level_values(-2).to_numpy(),
+        month=monthly.index.get_level_values(-1).to_numpy(),
+        freq='M',
+        name=monthly.index.names[-2],
+    )
+    if monthly.index.nlevels > 2:
+        periods = pd.MultiIndex.from_arrays(
+            [*(monthly.index.get_level_values(i) for i in range(monthly.index.nlevels - 2)), periods],
+        )
+    df.index = periods
+    return df
+
+
+def aggregate_windows(
+        cumulative: pd.DataFrame,
+        windows: Iterable[Tuple[int, int]],
+        **aggr_funcs,
+) -> pd.DataFrame:
+    groups = []
+    for st, end in windows:
+        window = window_totals(cumulative, st, end)
+        window = window.loc[window.xs('count', axis=1, level=1).sum(axis=1) > 0]
+        groups.append(combine_totals(window, **aggr_funcs).rename(
+            columns=lambda k: f'{k}_between_{st}_{end}_months',
+        ))
+    # windows drop their own empty years and concat appends the missing ones last
+    return pd.concat(groups, axis=1).sort_index()
+
+
+def assemble_date(
+        df: pd.DataFrame,
+        year_col: str = 'YEAR',
+        month_col: str = 'MO',
+        day_col: str = 'DY',
+        strict: bool = True,
+) -> pd.Series:
+    dates = pd.to_datetime(
+        df[[year_col, month_col, day_col]].set_axis(['year', 'month', 'day'], axis=1),
+        errors='coerce',
+    )
+    if strict and dates.isna().any():
+        invalid = df.loc[dates.isna(), [year_col, month_col, day_col]]
+        raise ValueError(f'invalid dates in {len(invalid)} rows: {invalid.head().to_dict("records")}')
+    return dates
+
+
 def filter_by_date(
         df: pd.DataFrame,
         date_cols: List[str],
@@ -85,21 +215,85 @@ class PandasTable:
     index_cols: List[str] = None
     date_cols: List[str] = None
     data: Optional[pd.DataFrame] = None
+    dtype: Optional[Dict[str, Any]] = None
+    usecols: Optional[List[str]] = None
+    storage: str = 'csv'
+    compression: Optional[str] = None
+    cached: bool = True
 
     def load(self):
         if self.path_io is not None:
-            self.data = pd.read_csv(self.path_io)
-            with suppress(Exception):
-                self.data = self.data.drop(['Unnamed: 0'], axis=1)
-            if self.date_cols is not None:
-                for col in self.date_cols:
-                    self.data[col] = pd.to_datetime(self.data[col])
-            if self.index_cols is not None:
-                self.data = self.data.set_index(self.index_cols)
+            version = file_version(self.path_io) if self.cached else None
+            if version is None:
+                self.data = self.read()
+            else:
+                self.data = TABLE_CACHE.get(
+                    ('load', os.fspath(self.path_io), version, self.options_key()),
+                    self.read,
+                )
         else:
             self.data = pd.read_csv(self.google_link)
             self.save()
 
+    def options_key(self) -> Tuple:
+        return tuple(
+            None if value is None else repr(value)
+            for value in (self.usecols, self.dtype, self.date_cols, self.index_cols)
+        )
+
+    def read(self) -> pd.DataFrame:
+        if columnar.is_columnar(self.path_io):
+            data = columnar.read_frame(self.path_io, self.usecols)
+        else:
+            data = pd.read_csv(
+                self.path_io,
+                dtype=self.dtype,
+                usecols=self.usecols,
+                compression=codec_of(self.path_io),
+            )
+            with suppress(Exception):
+                data = data.drop(['Unnamed: 0'], axis=1)
+        if self.date_cols is not None:
+            for col in self.date_cols:
+                data[col] = pd.to_datetime(data[col])
+        if self.index_cols is not None:
+            data = data.set_index(self.index_cols)
+        return data
+
+    def page(self, offset: int = 0, limit: Optional[int] = None, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        if columns is not None:
+            columns = list(dict.fromkeys(columns))
+        version = file_version(self.path_io) if self.cached else None
+        if version is None:
+            return self.read_page(offset, limit, columns)
+        return TABLE_CACHE.get(
+            ('page', os.fspath(self.path_io), version, offset, limit, None if columns is None else tuple(columns)),
+            lambda: self.read_page(offset, limit, columns),
+        )
+
+    def read_page(self, offset: int = 0, limit: Optional[int] = None, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        if columnar.is_columnar(self.path_io):
+            return columnar.read_frame(
+                self.path_io,
+                columns,
+                slice(offset, None if limit is None else offset + limit),
+            )
+        header = pd.read_csv(self.path_io, nrows=0, compression=codec_of(self.path_io)).columns
+        available = header.drop('Unnamed: 0', errors='ignore')
+        if columns is None:
+            columns = list(available)
+        elif missing := [col for col in columns if col not in available]:
+            raise KeyError(f'unknown columns: {missing}, available: {list(available)}')
+        return pd.read_csv(
+            self.path_io,
+            header=None,
+            names=header,
+            usecols=columns,
+            skiprows=offset + 1,
+            nrows=limit,
+            compression=codec_of(self.path_io),
+        )[columns]
+
     def drop_cols(self, *cols: str):
         self.data = self.data.drop(list(cols), index=1)
 
@@ -110,7 +304,10 @@ class PandasTable:
         return self.data[item]
 
     def save(self, *args, **kwargs):
-        self.data.to_csv(self.path_io)
+        if self.storage == 'columnar':
+            columnar.write_frame(self.data, self.path_io)
+        else:
+            self.data.to_csv(self.path_io, compression=pandas_compression(self.compression))
 
     @property
     def google_link(self):
@@ -120,6 +317,51 @@ class PandasTable:
         ds_view(self.data.sample(n))
 
 
+@dataclass(frozen=True)
+class Product:
+    func: Callable
+    needs: Tuple[str, ...] = ()
+
+
+def run_products(
+        graph: Dict[str, Product],
+        *names: str,
+        progress: Optional[Callable[[str, int, int], Any]] = None,
+        **sources,
+) -> Iterator[Tuple[str, Any]]:
+    order = []
+
+    def visit(name: str):
+        if name in sources or name in order:
+            return
+        for dep in graph[name].needs:
+            visit(dep)
+        order.append(name)
+
+    for name in names:
+        visit(name)
+
+    for name in names:
+        if name in sources:
+            yield name, sources[name]
+
+    consumers = Counter(dep for name in order for dep in graph[name].needs)
+    results = dict(sources)
+    for done, name in enumerate(order, 1):
+        product = graph[name]
+        results[name] = product.func(*(results[dep] for dep in product.needs))
+        if progress is not None:
+            progress(name, done, len(order))
+        for dep in product.needs:
+            consumers[dep] -= 1
+            if not consumers[dep]:
+                del results[dep]
+        if name in names:
+            yield name, results[name]
+        if not consumers[name]:
+            del results[name]
+
+
 @dataclass
 class DateRepr:
     part: str = 0
@@ -150,6 +392,19 @@ def create_decade(date) -> int:
     return DateRepr(get_decade_of_month(date), date.month, date.year)
 
 
+def decade_key(dates: pd.Series) -> pd.Series:
+    day_part = (dates.dt.day.clip(upper=21) - 1) // 10 + 1
+    return dates.dt.year * 1000 + dates.dt.month * 10 + day_part
+
+
+def decade_label(keys: pd.Index) -> pd.Index:
+    keys = pd.Series(keys, dtype='int64')
+    return pd.Index(
+        (keys % 10).astype(str) + '/' + (keys // 10 % 100).astype(str) + '/' + (keys // 1000).astype(str),
+        name='DECADE',
+    )
+
+
 class Dictable:
     _resource: str = ''
     _base_url: str = ''
@@ -182,3 +437,21 @@ def split_into_parts(sentence: str, words_per_part: int = 4) -> List[str]:
     words = sentence.split()
     parts = [words[i:i + words_per_part] for i in range(0, len(words), words_per_part)]
     return [' '.join(part) for part in parts]
+
+
+if __name__ == '__main__':
+    # DATE assembly benchmark: the old row-wise apply against assemble_date, rows per second
+    days = pd.date_range('1981-01-01', '2021-12-31')
+    calendar = pd.DataFrame({'YEAR': days.year, 'MO': days.month, 'DY': days.day})
+    calendar = calendar.iloc[np.resize(np.arange(len(calendar)), 1_000_000)].reset_index(drop=True)
+    for rows in (15_000, 1_000_000):
+        df = calendar.head(rows)
+        # the row-wise path is too slow for the full frame, it is timed on a slice
+        sample = df.head(20_000)
+        st = time.perf_counter()
+        sample.apply(lambda x: pd.to_datetime(f"{x['YEAR']}/{x['MO']}/{x['DY']}", yearfirst=True), axis=1)
+        row_wise = len(sample) / (time.perf_counter() - st)
+        st = time.perf_counter()
+        assemble_date(df)
+        bulk = rows / (time.perf_counter() - st)
+        print(f'{rows} rows: row-wise {row_wise:,.0f} rows/s, assemble_date {bulk:,.0f} rows/s')
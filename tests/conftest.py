@@ -0,0 +1,22 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+
+@pytest.fixture(scope='session')
+def weather_csv(tmp_path_factory):
+    rng = np.random.default_rng(0)
+    days = pd.date_range('1981-01-01', '2021-12-31')
+    path = tmp_path_factory.mktemp('weather') / 'weather.csv'
+    pd.DataFrame({
+        'LAT': 50.0,
+        'LON': 30.0,
+        'YEAR': days.year,
+        'MO': days.month,
+        'DY': days.day,
+        'T2M': (8 + 12 * np.sin((days.dayofyear.to_numpy() - 105) / 365 * 2 * np.pi) + rng.normal(0, 3, len(days))).round(2),
+        'PRECTOTCORR': rng.gamma(1, 1.6, len(days)).round(2),
+        'RH2M': rng.uniform(40, 98, len(days)).round(2),
+        'WS2M': rng.uniform(0, 8, len(days)).round(2),
+    }).to_csv(path, index=False)
+    return path
@@ -0,0 +1,12 @@
+import numpy as np
+import pandas as pd
+
+from scripts.shared import columnar
+
+
+def test_object_nulls_round_trip(tmp_path):
+    frame = pd.DataFrame({'name': ['a', None, np.nan], 'T2M': [1.5, np.nan, 3.0]})
+    columnar.write_frame(frame, tmp_path / 'table.col')
+    assert columnar.read_frame(tmp_path / 'table.col').to_json(orient='records') == frame.to_json(orient='records')
+    assert columnar.read_frame(tmp_path / 'table.col', ['name'], slice(1, None))['name'].isna().all()
+    assert b''.join(columnar.iter_csv(tmp_path / 'table.col')) == b'name,T2M\na,1.5\n,\n,3.0\n'
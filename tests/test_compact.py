@@ -0,0 +1,28 @@
+import pandas as pd
+import pytest
+
+from scripts.endpoints.csv_file import PRODUCT_TYPES
+from scripts.endpoints.proceed import WeatherTable
+
+# float32 measures against the float64 default, over every derived product,
+# ATOL covers means that land near zero where the float32 rounding is absolute
+RTOL = 1e-5
+ATOL = 1e-4
+
+
+@pytest.mark.parametrize('name', list(PRODUCT_TYPES))
+def test_compact_matches_default(weather_csv, name):
+    outputs = {}
+    for compact in (False, True):
+        table = WeatherTable(path_io=weather_csv, compact=compact)
+        table.load()
+        outputs[compact] = dict(table.products(name))[name]
+    pd.testing.assert_frame_equal(
+        outputs[True],
+        outputs[False],
+        check_dtype=False,
+        check_index_type=False,
+        check_exact=False,
+        rtol=RTOL,
+        atol=ATOL,
+    )
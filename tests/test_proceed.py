@@ -0,0 +1,203 @@
+import asyncio
+import logging
+import shutil
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+import pandas as pd
+import pytest
+from fastapi import HTTPException, UploadFile
+from tortoise import Tortoise
+
+from scripts.endpoints.csv_file import PRODUCT_TYPES, append_csv, proceed_csv, table_path
+from scripts.endpoints.proceed import WeatherPanel, WeatherTable, last_date
+from scripts.models.enums import CsvTypes
+from scripts.models.pg import CSVFile, User
+from scripts.shared import jobs
+from scripts.shared.lab_tools import PandasTable
+
+
+class QueryCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.queries = []
+
+    def emit(self, record: logging.LogRecord):
+        self.queries.append(record.getMessage())
+
+    @property
+    def inserts(self):
+        return [query for query in self.queries if query.lstrip().upper().startswith('INSERT')]
+
+
+def reset_pool():
+    jobs.get_pool().shutdown()
+    jobs.get_pool.cache_clear()
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'data' / 'csv').mkdir(parents=True)
+    # pool workers are forked with the working directory and classes of the first call
+    reset_pool()
+    yield tmp_path
+    reset_pool()
+
+
+async def add_input(path, user_id: str) -> CSVFile:
+    meta = await CSVFile.create(
+        name='st',
+        latitude=50,
+        longitude=30,
+        type=CsvTypes.input_data,
+        description='',
+        user_id=user_id,
+    )
+    shutil.copy(path, table_path(meta.id))
+    return meta
+
+
+@asynccontextmanager
+async def stored_input(path) -> AsyncIterator[CSVFile]:
+    await Tortoise.init(db_url='sqlite://:memory:', modules={'pg': ['scripts.models.pg']})
+    await Tortoise.generate_schemas()
+    try:
+        await User.create(name='u', scopes=['user'], pass_hash='')
+        yield await add_input(path, 'u')
+    finally:
+        await Tortoise.close_connections()
+
+
+async def proceed_input(path):
+    logger = logging.getLogger('tortoise.db_client')
+    level, counter = logger.level, QueryCounter()
+    async with stored_input(path) as meta:
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(counter)
+        try:
+            result = await proceed_csv({'username': 'u'}, f'{meta.id}')
+        except HTTPException as e:
+            result = e
+        finally:
+            logger.removeHandler(counter)
+            logger.setLevel(level)
+        return result, counter, await CSVFile.all().count()
+
+
+def test_proceed_inserts_once(workdir, weather_csv):
+    tables, counter, count = asyncio.run(proceed_input(weather_csv))
+    assert len(tables) == 9
+    # the user, the input row and one INSERT for all nine tables
+    assert len(counter.queries) == 3
+    assert len(counter.inserts) == 1
+    assert count == 10
+    assert not list(workdir.rglob('*.tmp'))
+
+
+def test_failed_worker_leaves_nothing(workdir, weather_csv, monkeypatch):
+    def fail(self, active_months):
+        raise RuntimeError('worker failed')
+
+    # most outputs are already written when gtk is computed
+    monkeypatch.setattr(WeatherTable, 'gtk', fail)
+    error, counter, count = asyncio.run(proceed_input(weather_csv))
+    assert isinstance(error, HTTPException) and error.status_code == 422
+    assert not counter.inserts
+    assert count == 1
+    assert not list(workdir.rglob('*.tmp'))
+
+
+def test_concurrent_proceeds(workdir, weather_csv, monkeypatch):
+    monkeypatch.setenv('PROCEED_WORKERS', '2')
+
+    async def proceed_twice():
+        async with stored_input(weather_csv) as meta:
+            return await asyncio.gather(*(proceed_csv({'username': 'u'}, f'{meta.id}') for _ in range(2)))
+
+    assert [len(tables) for tables in asyncio.run(proceed_twice())] == [9, 9]
+    assert not list(workdir.rglob('*.tmp'))
+
+
+@pytest.mark.parametrize('chunksize', [None, 5000])
+def test_last_date(weather_csv, chunksize):
+    assert last_date(weather_csv, chunksize) == [2021, 12, 31]
+
+
+def test_windows_keep_years_in_order(weather_csv):
+    table = WeatherTable(path_io=weather_csv, windows=((11, 3), (5, 6)))
+    table.load()
+    years = table.compute('gtk')['gtk'].index
+    assert years.is_monotonic_increasing and years[0] == 1981
+
+
+@pytest.mark.parametrize('name', list(PRODUCT_TYPES))
+def test_streamed_matches_in_memory(weather_csv, name):
+    in_memory = WeatherTable(path_io=weather_csv)
+    in_memory.load()
+    streamed = WeatherTable(path_io=weather_csv, chunksize=5000)
+    streamed.load()
+    pd.testing.assert_frame_equal(
+        dict(streamed.products(name))[name],
+        dict(in_memory.products(name))[name],
+        check_dtype=False,
+        rtol=1e-9,
+    )
+
+
+async def derived_tables(input_id) -> dict:
+    return {
+        table.type: PandasTable(path_io=table_path(table.id), cached=False).read()
+        for table in await CSVFile.filter(csv_file_id=input_id)
+    }
+
+
+async def append_part(input_id, path):
+    with open(path, 'rb') as f:
+        return await append_csv({'username': 'u'}, f'{input_id}', UploadFile(f, filename=path.name))
+
+
+def test_appends_match_full_proceed(workdir, weather_csv):
+    frame = pd.read_csv(weather_csv)
+    parts = {}
+    for name, rows in (('head', frame.YEAR <= 2010), ('middle', frame.YEAR.between(2011, 2015)), ('tail', frame.YEAR > 2015)):
+        parts[name] = workdir / f'{name}.csv'
+        frame[rows].to_csv(parts[name], index=False)
+
+    async def append_and_proceed():
+        async with stored_input(parts['head']) as meta:
+            await proceed_csv({'username': 'u'}, f'{meta.id}')
+            await append_part(meta.id, parts['middle'])
+            await append_part(meta.id, parts['tail'])
+            with pytest.raises(HTTPException) as overlap:
+                await append_part(meta.id, parts['middle'])
+            full = await add_input(weather_csv, 'u')
+            await proceed_csv({'username': 'u'}, f'{full.id}')
+            return overlap.value, await derived_tables(meta.id), await derived_tables(full.id)
+
+    overlap, appended, proceeded = asyncio.run(append_and_proceed())
+    assert overlap.status_code == 409
+    assert appended.keys() == proceeded.keys() and len(appended) == 9
+    for _type, table in appended.items():
+        pd.testing.assert_frame_equal(table, proceeded[_type], check_dtype=False, rtol=1e-9)
+    assert not list(workdir.rglob('*.tmp'))
+
+
+@pytest.mark.parametrize('name', list(PRODUCT_TYPES))
+def test_panel_matches_single_stations(tmp_path, weather_csv, name):
+    frame = pd.read_csv(weather_csv)
+    # a second station that starts later and runs warmer
+    stations = {'A': frame, 'B': frame[frame.YEAR >= 1990].assign(T2M=lambda df: df.T2M + 3)}
+    paths = {station: tmp_path / f'{station}.csv' for station in stations}
+    for station, rows in stations.items():
+        rows.to_csv(paths[station], index=False)
+    pd.concat([rows.assign(STATION=station) for station, rows in stations.items()]).to_csv(tmp_path / 'panel.csv', index=False)
+
+    panel = WeatherPanel(path_io=tmp_path / 'panel.csv')
+    panel.load()
+    split = dict(panel.split(panel.compute(name)[name]))
+    assert split.keys() == stations.keys()
+    for station, path in paths.items():
+        table = WeatherTable(path_io=path)
+        table.load()
+        pd.testing.assert_frame_equal(split[station], table.compute(name)[name], check_dtype=False, rtol=1e-9)